@@ -0,0 +1,250 @@
+from webclient import WebClient
+from cache import TTLCache
+from singleflight import SingleFlight
+from lazyimport import lazy_import
+import metrics
+import aiohttp
+import asyncio
+import logging
+import os
+
+
+log = logging.getLogger(__name__)
+bs4 = lazy_import('bs4')
+lazy_import('lxml.etree')  # used by bs4 as the parser, warmed alongside it
+
+
+ATLAS_URL = os.environ.get('ATLAS_URL', 'https://www.mc-atlas.com')
+ATLAS_USER = os.environ.get('ATLAS_USER')
+ATLAS_PASS = os.environ.get('ATLAS_PASS')
+ATLAS_COOKIE_FILE = os.environ.get('ATLAS_COOKIE_FILE')
+ATLAS_CACHE_TTL = int(os.environ.get('ATLAS_CACHE_TTL', 300))
+ATLAS_CACHE_STALE = int(os.environ.get('ATLAS_CACHE_STALE', 3600))
+ATLAS_CACHE_SIZE = int(os.environ.get('ATLAS_CACHE_SIZE', 64))
+LEADERBOARD_REFRESH = int(os.environ.get('ATLAS_LEADERBOARD_REFRESH', 600))
+LEADERBOARD_PAGES = ['Overall', 'Military', 'Industry', 'Technology', 'Culture', 'Misc']
+
+
+class AtlasLoginError(Exception):
+    """Exception used when Atlas rejects the login"""
+    pass
+
+
+def is_ok(response):
+    """Checks whether an Atlas API response was successful"""
+    return isinstance(response, dict) and response.get('Status') == 'OK'
+
+
+class AtlasClient(WebClient):
+    def __init__(self, *, loop=None, base_url=ATLAS_URL, cookie_file=ATLAS_COOKIE_FILE):
+        """Handles all requests to mc-atlas.com over one pooled session"""
+        super().__init__(loop=loop, limit_per_host=4, timeout=20,
+                         cookie_jar=aiohttp.CookieJar(unsafe=True, loop=loop))
+        self.base_url = base_url.rstrip('/')
+        self.cookie_file = cookie_file
+        self.logged_in = False
+        self.logins = 0
+        self._login_task = None
+        self.load_cookies()
+        self.cache = TTLCache(ttl=ATLAS_CACHE_TTL, stale_ttl=ATLAS_CACHE_STALE,
+                              max_size=ATLAS_CACHE_SIZE, loop=loop)
+        self.flights = SingleFlight('atlas', loop=loop)
+
+    def url(self, path):
+        """Turns an Atlas path into a full URL"""
+        return self.base_url + path
+
+    async def fetch(self, path, params=None, kind='text', authed=False):
+        """GETs an Atlas path, decoding the body as json, text or bytes, error statuses raise"""
+        if authed:
+            response = await self.authed_get(path, params=params, json=kind == 'json')
+        else:
+            response = await self.get(self.url(path), params=params)
+        response.raise_for_status()  # a 5xx or maintenance page once the retries ran out
+        if kind == 'json':
+            return response.json()
+        return response.text if kind == 'text' else response.body
+
+    def shared_fetch(self, path, params=None, kind='text', authed=False):
+        """Like fetch, but concurrent identical requests share one upstream call"""
+        key = (kind, authed) + self.cache.make_key(path, params)
+        return self.flights.do(key, lambda: self.fetch(path, params, kind, authed))
+
+    async def get_json(self, path, params=None):
+        return await self.shared_fetch(path, params, 'json')
+
+    async def cached_json(self, path, params=None):
+        """Gets an API response from the cache, refreshing it in the background when stale"""
+        key = self.cache.make_key(path, params)
+        return await self.cache.get_or_fetch(key, lambda: self.get_json(path, params=params), cacheable=is_ok)
+
+    async def get_text(self, path, params=None):
+        return await self.shared_fetch(path, params, 'text')
+
+    async def get_bytes(self, path, params=None):
+        return await self.shared_fetch(path, params, 'bytes')
+
+    def load_cookies(self):
+        """Restores a previously saved login, it is re-validated on first use"""
+        if self.cookie_file and os.path.exists(self.cookie_file):
+            try:
+                self.cookie_jar.load(self.cookie_file)
+                self.logged_in = True
+            except Exception:
+                log.warning('Could not load Atlas cookies from %s', self.cookie_file)
+
+    def save_cookies(self):
+        if self.cookie_file:
+            try:
+                self.cookie_jar.save(self.cookie_file)
+            except OSError:
+                log.warning('Could not save Atlas cookies to %s', self.cookie_file)
+
+    async def login(self):
+        """Logs in to Atlas, the session cookies are kept by the client"""
+        login_page = await self.get(self.url('/user/login'))
+        soup = bs4.BeautifulSoup(login_page.text, 'lxml')
+
+        form_build_id = soup.select_one('input[name=form_build_id]')['value']
+        form_id = soup.select_one('input[name=form_id]')['value']
+        op = soup.select_one('input[name=op]')['value']
+
+        data = {'name': ATLAS_USER,
+                'pass': ATLAS_PASS,
+                'form_build_id': form_build_id,
+                'form_id': form_id,
+                'op': op}
+
+        response = await self.post(self.url('/user/login'), data=data, allow_redirects=False)
+        if response.status not in (301, 302, 303):  # Drupal only redirects after a successful login
+            raise AtlasLoginError('Atlas rejected the login')
+        self.logins += 1
+        self.logged_in = True
+        self.save_cookies()
+        return response
+
+    async def ensure_login(self):
+        """Logs in if needed, concurrent callers share the same login attempt"""
+        if self.logged_in:
+            return
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self.login())
+            self._login_task.add_done_callback(self._login_done)
+        await asyncio.shield(self._login_task)
+
+    def _login_done(self, task):
+        self._login_task = None
+
+    def is_expired(self, response, json=False):
+        """Checks whether a response shows the login has expired"""
+        if response.status in (401, 403) or response.url.path.startswith('/user/login'):
+            return True
+        if json:
+            try:
+                response.json()
+            except ValueError:  # Atlas serves the login page instead of json
+                return True
+        return False
+
+    async def authed_get(self, path, params=None, json=False):
+        """Sends a request that needs a login, logging in again if the session expired"""
+        await self.ensure_login()
+        response = await self.get(self.url(path), params=params)
+        if self.is_expired(response, json):
+            self.logged_in = False
+            self.cookie_jar.clear()
+            await self.ensure_login()
+            response = await self.get(self.url(path), params=params)
+        return response
+
+    async def authed_json(self, path, params=None):
+        return await self.shared_fetch(path, params, 'json', authed=True)
+
+    async def authed_bytes(self, path, params=None):
+        return await self.shared_fetch(path, params, 'bytes', authed=True)
+
+
+class Leaderboard:
+    __slots__ = ('title', 'icon_url', 'rows')
+
+    def __init__(self, title, icon_url, rows):
+        """Represents a single parsed Atlas leaderboard"""
+        self.title = title
+        self.icon_url = icon_url
+        self.rows = rows
+
+    @classmethod
+    def from_tag(cls, tag, base_url):
+        nations_lis = tag.findAll('li')
+        rows = [(n.select_one('mark').text, n.select_one('small').text)
+                for n in nations_lis if n.select_one('mark').text != '-']
+        return cls(tag.select_one('h1').text, base_url + tag.select_one('img')['src'], rows)
+
+
+def parse_leaderboards(pages, base_url):
+    """Parses every leaderboard page into a dictionary of lower-cased category to Leaderboard"""
+    boards = {}
+    for page, html in zip(LEADERBOARD_PAGES, pages):
+        with metrics.timer('parse_seconds', kind='leaderboard'):
+            soup = bs4.BeautifulSoup(html, 'lxml')
+        top = soup.find('div', class_='large-leaderboard')
+        if top is not None and 'top nation' not in boards:
+            board = parse_board(top, page, base_url)
+            if board is not None:
+                boards['top nation'] = boards['top'] = board
+        board_class = 'leaderboard-mini' if page == 'Overall' else 'normal-leaderboard'
+        for tag in soup.findAll('div', class_=board_class):
+            board = parse_board(tag, page, base_url)
+            if board is not None:
+                boards.setdefault(board.title.lower(), board)
+    return boards
+
+
+def parse_board(tag, page, base_url):
+    """Parses one leaderboard, returns None if it is malformed so the rest of the page still loads"""
+    try:
+        return Leaderboard.from_tag(tag, base_url)
+    except (AttributeError, KeyError, TypeError):  # a missing h1, img or src
+        log.warning('Skipping a malformed leaderboard on the %s page', page)
+        return None
+
+
+class LeaderboardIndex:
+    def __init__(self, client, *, loop, interval=LEADERBOARD_REFRESH):
+        """Keeps every Atlas leaderboard parsed in memory, refreshed on a schedule"""
+        self.client = client
+        self.loop = loop
+        self.interval = interval
+        self.boards = {}
+        self.updated = None
+        self.ready = asyncio.Event()
+
+    async def refresh(self):
+        """Fetches all leaderboard pages concurrently and rebuilds the index, keeping the old one on failure"""
+        pages = await asyncio.gather(*(self.client.get_text('/leaderboards/' + page)
+                                       for page in LEADERBOARD_PAGES))
+        boards = await self.loop.run_in_executor(None, parse_leaderboards, pages, self.client.base_url)
+        if not boards:
+            raise ValueError('No leaderboards found on the Atlas leaderboard pages')
+        self.boards = boards
+        self.updated = self.loop.time()
+        self.ready.set()
+
+    async def run(self):
+        """Refreshes the index forever, retrying sooner after a failed refresh"""
+        while True:
+            try:
+                await self.refresh()
+                delay = self.interval
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Failed to refresh the Atlas leaderboards')
+                delay = 30
+            await asyncio.sleep(delay)
+
+    async def get(self, category, timeout=30):
+        """Gets a leaderboard by category, returns None if there is no such category"""
+        if not self.ready.is_set():
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        return self.boards.get(category.lower().strip())
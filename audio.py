@@ -0,0 +1,314 @@
+from collections import OrderedDict
+from extractor import Track
+import subprocess
+import threading
+import discord
+import shlex
+import struct
+import json
+import os
+
+
+AUDIO_PASSTHROUGH = os.environ.get('AUDIO_PASSTHROUGH', '1') != '0'
+FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
+OPUS_CODECS = {'opus'}
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', 'audio_cache')
+AUDIO_CACHE_BYTES = int(os.environ.get('AUDIO_CACHE_BYTES', 0))  # opt in, e.g. 2147483648 for 2GiB
+AUDIO_CACHE_MAX_DURATION = int(os.environ.get('AUDIO_CACHE_MAX_DURATION', 20 * 60))
+
+OGG_HEADER = struct.Struct('<4sBBqIIIB')
+
+
+class OggError(Exception):
+    """Exception used when ffmpeg's output isn't a valid Ogg stream"""
+    pass
+
+
+def iter_ogg_packets(stream):
+    """Reads an Ogg stream and yields the Opus packets inside it, skipping the Opus header packets"""
+    partial = b''
+    while True:
+        header = stream.read(OGG_HEADER.size)
+        if len(header) < OGG_HEADER.size:
+            return
+        capture, _, _, _, _, _, _, segments = OGG_HEADER.unpack(header)
+        if capture != b'OggS':
+            raise OggError('Invalid Ogg page')
+        lacing = stream.read(segments)
+        body = stream.read(sum(lacing))
+
+        offset = 0
+        size = 0
+        for value in lacing:
+            size += value
+            if value < 255:  # a lacing value below 255 ends the packet
+                packet = partial + body[offset:offset + size]
+                partial = b''
+                offset += size
+                size = 0
+                if not packet.startswith((b'OpusHead', b'OpusTags')):
+                    yield packet
+        if size:  # the packet carries on in the next page
+            partial += body[offset:offset + size]
+
+
+class TeeReader:
+    def __init__(self, stream, sink):
+        """Copies everything read from stream into sink"""
+        self.stream = stream
+        self.sink = sink
+
+    def read(self, size):
+        data = self.stream.read(size)
+        self.sink.write(data)
+        return data
+
+
+class FFmpegOpusAudio(discord.AudioSource):
+    def __init__(self, source, *, codec='copy', executable='ffmpeg', before_options=None, options=None,
+                 cache_writer=None):
+        """Streams Opus packets out of ffmpeg, remuxing without re-encoding when the input is already Opus
+
+        When a cache writer is given the Ogg stream is also saved to it, and
+        kept only if the track played through to the end."""
+        args = [executable]
+        if before_options:
+            args.extend(shlex.split(before_options))
+        args.extend(('-i', source, '-map_metadata', '-1', '-vn', '-f', 'opus', '-c:a', codec))
+        if codec != 'copy':
+            args.extend(('-ar', '48000', '-ac', '2', '-b:a', '128k'))
+        if options:
+            args.extend(shlex.split(options))
+        args.extend(('-loglevel', 'warning', 'pipe:1'))
+
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            if cache_writer is not None:
+                cache_writer.close(False)
+            raise discord.ClientException(executable + ' was not found.') from None
+        self._writer = cache_writer
+        stdout = self._process.stdout
+        self._packets = iter_ogg_packets(TeeReader(stdout, cache_writer) if cache_writer else stdout)
+        self._finished = False
+
+    def read(self):
+        packet = next(self._packets, b'')
+        if not packet:
+            self._finished = True
+        return packet
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        proc = self._process
+        if proc is None:
+            return
+        complete = self._finished and proc.wait() == 0
+        proc.kill()
+        if proc.poll() is None:
+            proc.communicate()
+        self._process = None
+        if self._writer is not None:
+            self._writer.close(complete)
+            self._writer = None
+
+
+class OggFileAudio(discord.AudioSource):
+    def __init__(self, path):
+        """Plays Opus packets straight out of a cached Ogg file, no ffmpeg process needed"""
+        self._file = open(path, 'rb')
+        self._packets = iter_ogg_packets(self._file)
+
+    def read(self):
+        return next(self._packets, b'')
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class CacheWriter:
+    def __init__(self, cache, track):
+        """Writes one track into the audio cache while it plays"""
+        self.cache = cache
+        self.track = track
+        self.path = cache.path(track.video_id) + '.part'
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self, complete):
+        self.file.close()
+        if complete and self.size:
+            self.cache.commit(self)
+        else:
+            self.cache.abort(self)
+
+
+class AudioCache:
+    def __init__(self, directory=AUDIO_CACHE_DIR, *, max_bytes=AUDIO_CACHE_BYTES,
+                 max_duration=AUDIO_CACHE_MAX_DURATION):
+        """On-disk cache of Opus audio keyed by video ID, evicting the least recently played files
+
+        Files are written while a track first plays and are used for every
+        later play. The index is shared between the event loop and the audio
+        player threads, so it is guarded by a lock. File modification times
+        double as the recency order, so it survives restarts."""
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.lock = threading.Lock()
+        self.files = OrderedDict()  # video id -> size, least recently used first
+        self.writing = set()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    def path(self, video_id):
+        return os.path.join(self.directory, video_id + '.ogg')
+
+    def scan(self):
+        """Rebuilds the index from the cache directory, dropping unfinished files"""
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+            elif entry.name.endswith('.ogg'):
+                stat = entry.stat()
+                found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+        with self.lock:
+            for _, vid, size in sorted(found):
+                self.files[vid] = size
+                self.size += size
+            self._evict()
+
+    def __contains__(self, video_id):
+        with self.lock:
+            return video_id in self.files
+
+    def open(self, video_id):
+        """Returns a source playing the cached file, or None on a miss"""
+        with self.lock:
+            if video_id not in self.files:
+                self.misses += 1
+                return None
+            self.files.move_to_end(video_id)
+            self.hits += 1
+            path = self.path(video_id)
+            try:
+                os.utime(path)
+                return OggFileAudio(path)
+            except OSError:  # removed from under us
+                self.size -= self.files.pop(video_id)
+                return None
+
+    def track(self, video_id):
+        """Returns the stored Track of a cached video, or None"""
+        if video_id not in self:
+            return None
+        try:
+            with open(os.path.join(self.directory, video_id + '.json')) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return Track(video_id, data['title'], data['duration'], data['thumbnail'], data['webpage_url'],
+                     None, None, 'opus')
+
+    def writer(self, track):
+        """Returns a CacheWriter for a track worth caching, or None"""
+        if not 0 < track.duration <= self.max_duration:  # live streams report no duration
+            return None
+        with self.lock:
+            if track.video_id in self.files or track.video_id in self.writing:
+                return None
+            self.writing.add(track.video_id)
+        try:
+            return CacheWriter(self, track)
+        except OSError:
+            with self.lock:
+                self.writing.discard(track.video_id)
+            return None
+
+    def commit(self, writer):
+        """Called from the audio player thread once a track has been written completely"""
+        track = writer.track
+        with open(os.path.join(self.directory, track.video_id + '.json'), 'w') as f:
+            json.dump({'title': track.title, 'duration': track.duration, 'thumbnail': track.thumbnail,
+                       'webpage_url': track.webpage_url}, f)
+        os.replace(writer.path, self.path(track.video_id))
+        with self.lock:
+            self.writing.discard(track.video_id)
+            self.files[track.video_id] = writer.size
+            self.size += writer.size
+            self.stores += 1
+            self._evict()
+
+    def abort(self, writer):
+        with self.lock:
+            self.writing.discard(writer.track.video_id)
+        try:
+            os.remove(writer.path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.files:
+            vid, size = self.files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            for path in (self.path(vid), os.path.join(self.directory, vid + '.json')):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self.lock:
+            max_bytes, self.max_bytes = self.max_bytes, 0
+            self._evict()
+            self.max_bytes = max_bytes
+
+    def stats(self):
+        """Returns a dictionary of cache statistics"""
+        lookups = self.hits + self.misses
+        return {'files': len(self.files),
+                'size': '{:.1f} MiB'.format(self.size / 1024 ** 2),
+                'budget': '{:.1f} MiB'.format(self.max_bytes / 1024 ** 2),
+                'writing': len(self.writing),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit rate': '{:.1%}'.format(self.hits / lookups) if lookups else 'n/a',
+                'stores': self.stores,
+                'evictions': self.evictions}
+
+
+def create_source(track, cache=None):
+    """Creates the cheapest audio source for a track
+
+    Cached tracks are read straight from disk. Otherwise Opus streams are
+    passed through and anything else is decoded to PCM, unless the track is
+    being cached, in which case it's encoded to Opus once while it plays.
+    The cache holds Opus, so nothing is written to it with AUDIO_PASSTHROUGH=0."""
+    if cache is not None:
+        source = cache.open(track.video_id)
+        if source is not None:
+            return source
+        writer = cache.writer(track) if AUDIO_PASSTHROUGH and track.stream_url else None
+        if writer is not None:
+            codec = 'copy' if track.codec in OPUS_CODECS else 'libopus'
+            return FFmpegOpusAudio(track.stream_url, codec=codec, before_options=FFMPEG_BEFORE_OPTIONS,
+                                   cache_writer=writer)
+    if AUDIO_PASSTHROUGH and track.codec in OPUS_CODECS:
+        return FFmpegOpusAudio(track.stream_url, before_options=FFMPEG_BEFORE_OPTIONS)
+    return discord.FFmpegPCMAudio(track.stream_url, before_options=FFMPEG_BEFORE_OPTIONS)
@@ -0,0 +1,297 @@
+"""Offline benchmark of the Atlas commands against a local stand-in for mc-atlas.com
+
+    python benchmarks/atlas_bench.py --nations 10 500 --coffers 1000 100000
+
+A local aiohttp server serves generated nation lists, leaderboard pages and
+coffer logs of the requested sizes. Each command runs once cold (empty caches
+and coffer store) and then --repeat times warm, through a fake Context. Peak
+memory comes from a separate cold pass under tracemalloc, and loop lag and
+stalls from the same watchdog the bot runs.
+"""
+from pathlib import Path
+import tracemalloc
+import argparse
+import shutil
+import tempfile
+import asyncio
+import logging
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+WORKDIR = tempfile.mkdtemp(prefix='atlas_bench_')
+os.environ.update(ATLAS_USER='bench', ATLAS_PASS='bench', COFFER_DB=os.path.join(WORKDIR, 'coffers.db'))
+
+from aiohttp import web  # noqa: E402
+from coffers import CofferStore  # noqa: E402
+from watchdog import LoopWatchdog  # noqa: E402
+import cogs  # noqa: E402
+
+NATION_ID = 277  # BLOTHERA_KINGDOM_ID
+PAGES = ['Overall', 'Military', 'Industry', 'Technology', 'Culture', 'Misc']
+
+
+def make_nations(count, citizens, rng):
+    nations = []
+    for n in range(count):
+        nations.append({
+            'nationName': 'Nation{}'.format(n),
+            'nationIsAdmin': n == 0,
+            'citizens': [{'userName': 'player{}_{}'.format(n, c),
+                          'userUuid': '{:032x}'.format(rng.getrandbits(128)),
+                          'isLeader': c == 0,
+                          'userLastSeenTime': 0 if c % 7 == 0 else 1546300800000 + rng.randrange(10 ** 10)}
+                         for c in range(citizens)],
+            'towns': [{'townName': 'Town{}_{}'.format(n, t)} for t in range(max(citizens // 5, 1))],
+        })
+    return {'Status': 'OK', 'Data': {'nationList': nations}}
+
+
+def make_leaderboard_page(page, rows):
+    def board(tag, title):
+        items = ''.join('<li><mark>Nation{}</mark><small>{}</small></li>'.format(i, 10 ** 6 - i)
+                        for i in range(rows))
+        return ('<div class="{}"><img src="/icons/{}.png"><h1>{}</h1><ol>{}</ol></div>'
+                .format(tag, title.lower(), title, items))
+    boards = [board('large-leaderboard', 'Top Nation')] if page == 'Overall' else []
+    tag = 'leaderboard-mini' if page == 'Overall' else 'normal-leaderboard'
+    boards.extend(board(tag, '{} {}'.format(page, i)) for i in range(8))
+    return '<html><body>{}</body></html>'.format(''.join(boards))
+
+
+def make_coffer_log(count, rng):
+    """Coffer history newest first, as the Atlas API returns it"""
+    now = int(time.time() * 1000)
+    coffers = 10 ** 6
+    history = []
+    for i in range(count):
+        delta = rng.randrange(1, 5000)
+        kind = rng.choice(('Player Deposit', 'Player Withdraw', 'Nation Upkeep'))
+        coffers += delta if kind == 'Player Deposit' else -delta
+        history.append({'Timestamp': now - (count - i) * 60000, 'Description': kind, 'NationCoffers': coffers,
+                        'Metadata': {'PlayerName': 'player{}'.format(i % 50)} if kind.startswith('Player') else {}})
+    history.reverse()
+    return history
+
+
+class FixtureServer:
+    def __init__(self, *, nations, citizens, coffers, rows):
+        """Stand-in for mc-atlas.com serving generated fixtures"""
+        rng = random.Random(0)
+        self.nations = json.dumps(make_nations(nations, citizens, rng)).encode()
+        self.pages = {page: make_leaderboard_page(page, rows) for page in PAGES}
+        self.coffers = make_coffer_log(coffers, rng)
+        self.runner = None
+        self.url = None
+
+    async def nation_list(self, request):
+        return web.Response(body=self.nations, content_type='application/json')
+
+    async def leaderboard(self, request):
+        return web.Response(text=self.pages[request.match_info['page']], content_type='text/html')
+
+    async def login_page(self, request):
+        return web.Response(text='<form><input name="form_build_id" value="b"><input name="form_id" value="f">'
+                                 '<input name="op" value="Log in"></form>', content_type='text/html')
+
+    async def login(self, request):
+        response = web.Response(status=302, headers={'Location': '/'})
+        response.set_cookie('SESS', 'bench')
+        return response
+
+    async def coffer_log(self, request):
+        since = int(request.query.get('MinTime', 0))
+        history = [h for h in self.coffers if h['Timestamp'] > since]
+        return web.json_response({'Status': 'OK', 'Data': {'CofferHistory': history}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/nation/api/nation/list', self.nation_list)
+        app.router.add_get('/leaderboards/{page}', self.leaderboard)
+        app.router.add_get('/user/login', self.login_page)
+        app.router.add_post('/user/login', self.login)
+        app.router.add_get('/nation/v2/api/getcofferlog', self.coffer_log)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.runner.addresses[0][1])
+
+    async def close(self):
+        await self.runner.cleanup()
+
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeContext:
+    """Just enough of commands.Context for the Atlas commands"""
+    guild = None
+    author = None
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append((content, kwargs))
+        return FakeMessage()
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+
+
+def commands(cog, nation, fresh_store):
+    """The benchmarked commands as (name, reset, cold, warm)
+
+    reset, if given, runs untimed before the cold run, and cold, if given,
+    replaces warm for it. The leaderboard command answers from the
+    in-memory index, so its cold run builds the index first, the way the
+    first command after startup waits for it. The coffer commands each
+    start cold from an empty store, so they pay for the initial sync rather
+    than reusing the one an earlier command did."""
+    def empty_store():
+        cog.coffers.close()
+        cog.coffers = fresh_store()
+
+    async def leaderboard_cold():
+        await cog.leaderboards.refresh()
+        await leaderboard()
+
+    leaderboard = lambda: cog.leaderboard.callback(cog, FakeContext(), category='military 3')
+    blothera = lambda request: lambda: cog.blothera.callback(cog, FakeContext(), request=request)
+    return [
+        ('nations', None, None, lambda: cog.nations.callback(cog, FakeContext(), name='')),
+        ('nations <name>', None, None, lambda: cog.nations.callback(cog, FakeContext(), name=nation)),
+        ('leaderboard', None, leaderboard_cold, leaderboard),
+        ('blothera playerlogs', empty_store, None, blothera('playerlogs')),
+        ('blothera coffers', empty_store, None, blothera('coffers')),
+        ('blothera coffers 30d', empty_store, None, blothera('coffers 30d')),
+    ]
+
+
+async def measure(watchdog, func):
+    """Runs one command, returning wall time, CPU time, the worst loop lag and stalls"""
+    watchdog.samples.clear()
+    stalls = watchdog.stalls
+    await asyncio.sleep(watchdog.interval * 2)  # let the ticker settle
+    watchdog.samples.clear()
+    wall, cpu = time.perf_counter(), time.process_time()
+    await func()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    await asyncio.sleep(watchdog.interval * 2)  # collect the sample that covers the end of the command
+    lag = max(watchdog.samples, default=0.0)
+    return wall, cpu, lag, watchdog.stalls - stalls
+
+
+async def peak_memory(func):
+    tracemalloc.start()
+    try:
+        await func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def make_cog(loop, server):
+    """Builds an Atlas cog with empty caches pointed at the fixture server"""
+    cog = cogs.Atlas(FakeBot(loop))
+    cog.atlas.base_url = server.url
+    cog.leaderboard_task.cancel()  # before it runs, so it can't warm the index ahead of the cold run
+    cog.coffers.close()
+    cog.coffers = fresh_store(loop)
+    return cog
+
+
+def fresh_store(loop):
+    """Opens an empty coffer store in a new database file"""
+    fd, path = tempfile.mkstemp(suffix='.db', dir=WORKDIR)
+    os.close(fd)
+    return CofferStore(path, loop=loop)
+
+
+async def unload(cog):
+    cog.cog_unload()
+    await asyncio.sleep(0)  # let the client close
+
+
+async def bench(loop, args, nations, coffers, watchdog):
+    server = FixtureServer(nations=nations, citizens=args.citizens, coffers=coffers, rows=args.rows)
+    await server.start()
+    nation = 'Nation{}'.format(nations - 1)
+    peaks = {}
+    try:
+        if args.memory:  # a separate cold pass, tracemalloc would skew the timings
+            cog = make_cog(loop, server)
+            try:
+                for name, reset, cold, warm in commands(cog, nation, lambda: fresh_store(loop)):
+                    if reset is not None:
+                        reset()
+                    peaks[name] = await peak_memory(cold or warm)
+            finally:
+                await unload(cog)
+
+        cog = make_cog(loop, server)
+        try:
+            for name, reset, cold_func, warm_func in commands(cog, nation, lambda: fresh_store(loop)):
+                if reset is not None:
+                    reset()
+                cold = await measure(watchdog, cold_func or warm_func)
+                warm = [await measure(watchdog, warm_func) for _ in range(args.repeat)]
+                best = min(warm, key=lambda r: r[0]) if warm else cold
+                print('{:<22} {:>8} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6}'.format(
+                    name, nations, coffers, cold[0] * 1000, best[0] * 1000, cold[1] * 1000,
+                    peaks.get(name, 0) / 1024 ** 2, max(cold[2], best[2]) * 1000,
+                    cold[3] + sum(r[3] for r in warm)))
+        finally:
+            await unload(cog)
+    finally:
+        await server.close()
+
+
+async def main(loop, args):
+    watchdog = LoopWatchdog(loop, interval=0.01, threshold=args.threshold)
+    watchdog.start()
+    print('{:<22} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+        'command', 'nations', 'coffers', 'cold ms', 'warm ms', 'cold cpu', 'peak MiB', 'lag ms', 'stalls'))
+    try:
+        for nations in args.nations:
+            for coffers in args.coffers:
+                await bench(loop, args, nations, coffers, watchdog)
+    finally:
+        watchdog.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nations', type=int, nargs='+', default=[10, 500])
+    parser.add_argument('--citizens', type=int, default=30, help='citizens per nation')
+    parser.add_argument('--coffers', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--rows', type=int, default=10, help='rows per leaderboard')
+    parser.add_argument('--repeat', type=int, default=3, help='warm runs per command')
+    parser.add_argument('--threshold', type=float, default=0.05,
+                        help='loop lag in seconds reported as a stall, with its stack')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc pass, which is slow on large fixtures')
+    parser.add_argument('--verbose', action='store_true', help='log stall stack traces')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING if args.verbose else logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(main(loop, args))
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
@@ -0,0 +1,250 @@
+"""Load test of the music subsystem with many simulated guilds
+
+    python benchmarks/music_load.py --guilds 10 100 500 --duration 30
+
+Each guild gets a real VoiceState and MusicQueue driven by random play, skip,
+shuffle, loop and stop traffic. Voice is a fake client that "plays" for
+--song-seconds. Extraction goes through the real ExtractorPool, with
+youtube_dl replaced by a sleep of --latency seconds on the worker threads.
+"""
+from pathlib import Path
+import tracemalloc
+import argparse
+import asyncio
+import logging
+import random
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from extractor import ExtractorPool  # noqa: E402
+from watchdog import LoopWatchdog  # noqa: E402
+import newmusic  # noqa: E402
+
+
+class FakeExtractorPool(ExtractorPool):
+    def __init__(self, *, loop, latency, jitter, workers):
+        """ExtractorPool whose youtube_dl calls just sleep for the configured latency"""
+        super().__init__({}, loop=loop, workers=workers)
+        self.latency = latency
+        self.jitter = jitter
+
+    def _extract(self, url):
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        return {'id': url, 'title': 'Song ' + url, 'duration': 180, 'thumbnail': None,
+                'webpage_url': 'https://www.youtube.com/watch?v=' + url,
+                'url': 'fake://' + url, 'acodec': 'opus'}
+
+
+class FakeSource:
+    def __init__(self, track, cache=None):
+        self.track = track
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, state, song_seconds, transitions):
+        """Plays each source for song_seconds, calling after like discord's player thread would
+
+        The time from a song ending to the next play call is recorded as a
+        transition, but only when another song was already queued."""
+        self.state = state
+        self.loop = state.bot.loop
+        self.song_seconds = song_seconds
+        self.transitions = transitions
+        self.channel = None
+        self.handle = None
+        self.after = None
+        self.paused = False
+        self.ended = None
+
+    def play(self, source, *, after=None):
+        if self.ended is not None:
+            self.transitions.append(time.perf_counter() - self.ended)
+            self.ended = None
+        self.after = after
+        self.handle = self.loop.call_later(self.song_seconds, self.finish)
+
+    def finish(self):
+        self.handle = None
+        if self.state.queue.get_next_song() is not None:
+            self.ended = time.perf_counter()
+        after, self.after = self.after, None
+        if after is not None:
+            after(None)
+
+    def is_playing(self):
+        return self.handle is not None and not self.paused
+
+    def is_paused(self):
+        return self.paused
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.finish()
+
+    async def disconnect(self):
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self, id):
+        self.id = id
+        self.name = 'guild{}'.format(id)
+
+
+class FakeChannel:
+    def __init__(self, guild):
+        self.guild = guild
+
+    async def send(self, content=None, **kwargs):
+        pass
+
+
+class FakeContext:
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = FakeChannel(guild)
+        self.author = 'listener'
+
+
+class FakeBot:
+    def __init__(self, loop):
+        self.loop = loop
+
+
+def pick_video(rng, catalog):
+    """Picks a video id with a skew towards popular songs, like real traffic"""
+    return '{:011d}'.format(min(int(rng.paretovariate(1.2)) - 1, catalog - 1))
+
+
+async def traffic(state, ctx, rng, args, extractor, counts):
+    """Random play/skip/shuffle/loop/stop commands for one guild"""
+    loop = state.bot.loop
+    actions = ['play'] * 6 + ['skip'] * 2 + ['shuffle', 'loop', 'stop']
+    while True:
+        await asyncio.sleep(rng.expovariate(1 / args.action_interval))
+        action = rng.choice(actions)
+        counts[action] = counts.get(action, 0) + 1
+        try:
+            if action == 'play':
+                song = newmusic.YouTubeVideo(pick_video(rng, args.catalog), loop=loop, extractor=extractor)
+                state.add_song_to_playlist(song, context=ctx)
+            elif action == 'skip':
+                state.skip()
+            elif action == 'shuffle':
+                state.shuffle()
+            elif action == 'loop':
+                state.loop()
+            else:
+                state.stop()
+        except newmusic.QueueEmpty:
+            pass
+
+
+async def run(loop, args, guilds):
+    extractor = FakeExtractorPool(loop=loop, latency=args.latency, jitter=args.jitter, workers=args.workers)
+    watchdog = LoopWatchdog(loop, interval=0.01, threshold=args.threshold)
+    watchdog.start()
+    transitions = []
+    counts = {}
+    states = []
+    tasks = []
+    rng = random.Random(guilds)
+    for n in range(guilds):
+        state = newmusic.VoiceState(FakeBot(loop))
+        state.voice = FakeVoiceClient(state, args.song_seconds, transitions)
+        states.append(state)
+        tasks.append(loop.create_task(traffic(state, FakeContext(FakeGuild(n)), rng, args, extractor, counts)))
+
+    task_counts = []
+    deadline = loop.time() + args.duration
+    while loop.time() < deadline:
+        await asyncio.sleep(0.5)
+        task_counts.append(len(asyncio.all_tasks()))
+
+    lag = watchdog.percentiles()
+    for task in tasks:
+        task.cancel()
+    for state in states:
+        await state.disconnect()
+    watchdog.stop()
+    extractor.close()
+    await asyncio.sleep(0)
+
+    transitions.sort()
+    pick = lambda q: transitions[min(int(q * len(transitions)), len(transitions) - 1)] if transitions else 0.0
+    print('{:>6} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>6} {:>9} {:>7}'.format(
+        guilds, len(transitions), pick(0.5) * 1000, pick(0.95) * 1000, pick(0.99) * 1000,
+        lag.get('p50', 0) * 1000, lag.get('p95', 0) * 1000, lag.get('max', 0) * 1000, watchdog.stalls,
+        '{}/{}'.format(max(task_counts, default=0), task_counts[-1] if task_counts else 0),
+        memory_per_guild(loop, args, extractor) if args.memory else '-'))
+    if args.verbose:
+        print('  commands: {}'.format(', '.join('{} {}'.format(k, v) for k, v in sorted(counts.items()))))
+        print('  extractor: {}'.format(', '.join('{} {}'.format(k, v) for k, v in extractor.stats().items())))
+
+
+def memory_per_guild(loop, args, extractor, guilds=50):
+    """Measures what one idle guild with a queue of --queue songs costs, in KiB"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        states = []
+        for n in range(guilds):
+            state = newmusic.VoiceState(FakeBot(loop))
+            ctx = FakeContext(FakeGuild(n))
+            for i in range(args.queue):
+                song = newmusic.YouTubeVideo('{:011d}'.format(i), loop=loop, extractor=extractor)
+                state.queue.add(song)
+                song.channel, song.requester = ctx.channel, ctx.author
+            states.append(state)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    for state in states:
+        state.music_player.cancel()
+    return '{:.1f}'.format(used / guilds / 1024)
+
+
+async def main(loop, args):
+    newmusic.create_source = FakeSource  # no ffmpeg, the fake voice client never reads audio
+    print('{:>6} {:>7} {:>9} {:>9} {:>9} {:>8} {:>8} {:>8} {:>6} {:>9} {:>7}'.format(
+        'guilds', 'trans', 'trans p50', 'trans p95', 'trans p99', 'lag p50', 'lag p95', 'lag max',
+        'stalls', 'tasks', 'KiB/gld'))
+    for guilds in args.guilds:
+        await run(loop, args, guilds)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--guilds', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--duration', type=float, default=20, help='seconds of traffic per run')
+    parser.add_argument('--song-seconds', type=float, default=3, help='how long each song "plays"')
+    parser.add_argument('--action-interval', type=float, default=2, help='mean seconds between commands per guild')
+    parser.add_argument('--latency', type=float, default=0.3, help='seconds per youtube_dl extraction')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--workers', type=int, default=3, help='extractor threads')
+    parser.add_argument('--catalog', type=int, default=2000, help='distinct videos to pick from')
+    parser.add_argument('--queue', type=int, default=100, help='queued songs per guild in the memory pass')
+    parser.add_argument('--threshold', type=float, default=0.05, help='loop lag in seconds counted as a stall')
+    parser.add_argument('--no-memory', dest='memory', action='store_false')
+    parser.add_argument('--verbose', action='store_true', help='show command and extractor counts')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(main(loop, args))
@@ -0,0 +1,158 @@
+"""Micro-benchmark of the indexed MusicQueue against the old list based queue
+
+    python benchmarks/queue_bench.py --sizes 100 1000 10000
+"""
+from pathlib import Path
+import argparse
+import random
+import time
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from musicqueue import MusicQueue  # noqa: E402
+
+
+class ListMusicQueue:
+    """The list based queue MusicQueue replaced, kept for comparison"""
+
+    def __init__(self):
+        self.normal = []
+        self.shuffled = []
+        self.looping = []
+
+    def loop(self, *, nowplaying):
+        if not self.looping:
+            self.looping = list(self.visible)
+            self.looping.insert(0, nowplaying)
+            if not self.visible:
+                self.visible = list(self.looping)
+        else:
+            self.looping = []
+        return bool(self.looping)
+
+    def shuffle(self):
+        if not self.shuffled:
+            self.shuffled = list(self.visible)
+            random.shuffle(self.shuffled)
+        else:
+            self.shuffled = []
+        return bool(self.shuffled)
+
+    def get_next_song(self):
+        try:
+            song = None
+            song = self.normal[0]
+            song = self.shuffled[0]
+        except IndexError:
+            pass
+        return song
+
+    def remove(self, obj):
+        self.normal.remove(obj)
+        if self.shuffled:
+            self.shuffled.remove(obj)
+        if not self.normal:
+            self.normal = list(self.looping)
+            self.shuffled = list(self.looping)
+
+    def add(self, obj):
+        self.normal.append(obj)
+        if self.shuffled:
+            self.shuffled.append(obj)
+        if self.looping:
+            self.looping.append(obj)
+
+    @property
+    def visible(self):
+        return self.shuffled if self.shuffled else self.normal
+
+    @visible.setter
+    def visible(self, new):
+        if self.shuffled:
+            self.shuffled = new
+        self.normal = new
+
+
+class Song:
+    __slots__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+
+
+def filled(queue_cls, songs):
+    queue = queue_cls()
+    for song in songs:
+        queue.add(song)
+    return queue
+
+
+def add_and_announce(queue, songs):
+    """b!play: add a song then show its position, as YouTubeVideo.embed does"""
+    for song in songs:
+        queue.add(song)
+        queue.visible.index(song)
+
+
+def shuffled_playback(queue, songs):
+    """Shuffle a full queue then play it through"""
+    queue.shuffle()
+    while queue.get_next_song() is not None:
+        queue.remove(queue.get_next_song())
+
+
+def random_removal(queue, songs):
+    """Remove songs from random positions of a full queue"""
+    order = list(songs)
+    random.Random(0).shuffle(order)
+    for song in order:
+        queue.remove(song)
+
+
+def page_views(queue, songs):
+    """b!queue: view every page of ten songs"""
+    for offset in range(0, len(songs), 10):
+        queue.visible[offset:offset + 10]
+
+
+def loop_toggles(queue, songs):
+    """Toggle looping and shuffling on a full queue a hundred times"""
+    for _ in range(100):
+        queue.loop(nowplaying=songs[0])
+        queue.shuffle()
+
+
+# (scenario, whether it starts from a full queue), filling it isn't part of the timing
+SCENARIOS = [(add_and_announce, False), (shuffled_playback, True), (random_removal, True),
+             (page_views, True), (loop_toggles, True)]
+
+
+def measure(func, queue_cls, songs, repeat, prefill):
+    best = float('inf')
+    for _ in range(repeat):
+        queue = filled(queue_cls, songs) if prefill else queue_cls()
+        start = time.perf_counter()
+        func(queue, songs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:<20} {:>7} {:>12} {:>12} {:>8}'.format('scenario', 'songs', 'list (ms)', 'indexed (ms)', 'speedup'))
+    for size in args.sizes:
+        songs = [Song(n) for n in range(size)]
+        for scenario, prefill in SCENARIOS:
+            old = measure(scenario, ListMusicQueue, songs, args.repeat, prefill)
+            new = measure(scenario, MusicQueue, songs, args.repeat, prefill)
+            print('{:<20} {:>7} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(
+                scenario.__name__, size, old * 1000, new * 1000, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 from discord.ext import commands
+import lazyimport
 import logging
+import time
 import os
 
 
@@ -7,6 +9,8 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
     blothera_bot = commands.Bot(command_prefix='b!')
-    blothera_bot.load_extension('cogs')
-    blothera_bot.load_extension('newmusic')
+    for extension in ('cogs', 'newmusic'):
+        start = time.perf_counter()
+        blothera_bot.load_extension(extension)
+        lazyimport.record_extension(extension, time.perf_counter() - start)
     blothera_bot.run(os.environ.get("TOKEN"))
\ No newline at end of file
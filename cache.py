@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import asyncio
+import logging
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    __slots__ = ('value', 'stored')
+
+    def __init__(self, value, stored):
+        self.value = value
+        self.stored = stored
+
+
+class TTLCache:
+    def __init__(self, *, ttl=300, stale_ttl=3600, max_size=128, loop=None):
+        """A size bounded LRU cache with expiry and stale-while-revalidate
+
+        Entries younger than ttl are served as they are. Entries younger than
+        ttl + stale_ttl are served immediately while a background refresh
+        replaces them. Anything older is fetched before returning."""
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.loop = loop
+        self.entries = OrderedDict()
+        self.refreshing = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(endpoint, params=None):
+        """Builds a hashable key from an endpoint and its parameters"""
+        return (endpoint, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Returns the cached entry for key, or None"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value):
+        self.entries[key] = CacheEntry(value, time.monotonic())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Flushes every entry"""
+        self.entries.clear()
+
+    async def get_or_fetch(self, key, fetch, *, cacheable=None):
+        """Gets a value from the cache, calling the fetch coroutine function if needed"""
+        entry = self.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.stored
+            if age < self.ttl:
+                self.hits += 1
+                return entry.value
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self.revalidate(key, fetch, cacheable)
+                return entry.value
+
+        self.misses += 1
+        value = await fetch()
+        if cacheable is None or cacheable(value):
+            self.set(key, value)
+        return value
+
+    def revalidate(self, key, fetch, cacheable=None):
+        """Refreshes an entry in the background, once per key"""
+        if key in self.refreshing:
+            return
+        loop = self.loop or asyncio.get_event_loop()
+        self.refreshing[key] = loop.create_task(self._refresh(key, fetch, cacheable))
+
+    async def _refresh(self, key, fetch, cacheable):
+        try:
+            value = await fetch()
+            if cacheable is None or cacheable(value):
+                self.set(key, value)
+                self.refreshes += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.refresh_failures += 1
+            log.exception('Failed to refresh cache entry %r, serving the stale copy', key)
+        finally:
+            self.refreshing.pop(key, None)
+
+    def stats(self):
+        """Returns a dictionary of cache statistics"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {'entries': len(self.entries),
+                'max size': self.max_size,
+                'hits': self.hits,
+                'stale hits': self.stale_hits,
+                'misses': self.misses,
+                'hit rate': '{:.1%}'.format((self.hits + self.stale_hits) / lookups) if lookups else 'n/a',
+                'refreshes': self.refreshes,
+                'refresh failures': self.refresh_failures,
+                'evictions': self.evictions}
@@ -0,0 +1,125 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from lazyimport import lazy_import
+from io import BytesIO
+import metrics
+import os
+import re
+
+
+np = lazy_import('numpy')
+matplotlib = lazy_import('matplotlib', setup=lambda mpl: mpl.use('Agg'))
+backend_agg = lazy_import('matplotlib.backends.backend_agg')
+figure = lazy_import('matplotlib.figure')
+mdates = lazy_import('matplotlib.dates')
+style = lazy_import('matplotlib.style')
+
+
+COFFER_GRAPH_POINTS = int(os.environ.get('COFFER_GRAPH_POINTS', 500))
+DURATION_UNITS = {'h': 3600, 'd': 86400, 'w': 604800, 'm': 2592000, 'y': 31536000}
+
+
+def parse_duration(text):
+    """Converts a range such as 12h, 30d, 2w, 6m or 1y into seconds, returns None if invalid"""
+    match = re.fullmatch(r'(\d+)\s*([hdwmy])', text.strip().lower())
+    if match is None or int(match.group(1)) == 0:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+
+def to_epoch_seconds(timestamps):
+    """Converts Atlas timestamps to epoch seconds, accepts seconds, milliseconds or microseconds"""
+    ts = np.asarray(timestamps, dtype=np.int64)
+    return np.where(ts >= 10 ** 14, ts // 10 ** 6, np.where(ts >= 10 ** 11, ts // 1000, ts))
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets downsampling of an ascending series to threshold points"""
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    xf = x.astype(np.float64)
+    yf = y.astype(np.float64)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = a = 0
+    indices[-1] = n - 1
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        if end < next_end:
+            avg_x = xf[end:next_end].mean()
+            avg_y = yf[end:next_end].mean()
+        else:
+            avg_x, avg_y = xf[-1], yf[-1]
+        areas = np.abs((xf[a] - avg_x) * (yf[start:end] - yf[a]) - (xf[a] - xf[start:end]) * (avg_y - yf[a]))
+        a = start + int(areas.argmax())
+        indices[i + 1] = a
+    return x[indices], y[indices]
+
+
+def render_coffers(timestamps, coffer_logs, since=None, max_points=COFFER_GRAPH_POINTS,
+                   title='Kingdom of Blothera Coffers'):
+    """Renders the coffer history to PNG bytes, runs on the chart worker thread"""
+    seconds = to_epoch_seconds(timestamps)[::-1]  # the store returns newest first
+    coffers = np.asarray(coffer_logs, dtype=np.int64)[::-1]
+    if since is not None:
+        start = np.searchsorted(seconds, since)
+        seconds, coffers = seconds[start:], coffers[start:]
+    seconds, coffer_logs = lttb(seconds, coffers, max_points)
+    date_logs = seconds.astype('datetime64[s]')
+
+    with style.context('dark_background'):
+        fig = figure.Figure()
+        backend_agg.FigureCanvasAgg(fig)  # attaches itself to the figure, pyplot never sees it
+        try:
+            ax = fig.add_subplot(111)
+
+            ax.set_title(title)
+            ax.set_xlabel('Date')
+            ax.set_ylabel('Coffers')
+            ax.plot(date_logs, coffer_logs, label='Coffers')
+
+            loc = mdates.AutoDateLocator()
+            loc.intervald[mdates.HOURLY] = [24]
+            ax.xaxis.set_major_locator(loc)
+            fmter = mdates.DateFormatter('%d/%m/%Y')
+            ax.xaxis.set_major_formatter(fmter)
+
+            image = BytesIO()
+            fig.savefig(image, format='png', transparent=True)
+            return image.getvalue()
+        finally:
+            fig.clear()
+
+
+class ChartRenderer:
+    def __init__(self, *, loop, cache_size=8):
+        """Renders charts on a dedicated worker thread and caches the PNG bytes"""
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=1)  # matplotlib is not thread safe
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def cached(self, key):
+        """Returns the cached PNG bytes for key, or None"""
+        image = self.cache.get(key)
+        if image is not None:
+            self.cache.move_to_end(key)
+        return image
+
+    async def render(self, key, func, *args):
+        """Renders a chart with func unless one for key is already cached"""
+        image = self.cached(key)
+        if image is None:
+            with metrics.timer('render_seconds', chart=func.__name__):
+                image = await self.loop.run_in_executor(self.executor, func, *args)
+            self.cache[key] = image
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return image
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.cache.clear()
@@ -0,0 +1,107 @@
+import threading
+import sqlite3
+import asyncio
+import json
+import os
+
+
+COFFER_DB = os.environ.get('COFFER_DB', 'coffers.db')
+COFFER_SYNC_INTERVAL = int(os.environ.get('COFFER_SYNC_INTERVAL', 60))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coffer_history (
+    nation_id INTEGER NOT NULL,
+    timestamp INTEGER NOT NULL,
+    description TEXT NOT NULL,
+    player TEXT NOT NULL,
+    coffers INTEGER NOT NULL,
+    metadata TEXT,
+    UNIQUE (nation_id, timestamp, description, player, coffers)
+);
+CREATE INDEX IF NOT EXISTS coffer_history_time ON coffer_history (nation_id, timestamp);
+DROP INDEX IF EXISTS coffer_history_player;
+"""
+
+
+def timestamp_scale(timestamp):
+    """Returns how many units of an Atlas timestamp make a second, they come in s, ms or us"""
+    if timestamp is None or timestamp < 10 ** 11:
+        return 1
+    return 1000 if timestamp < 10 ** 14 else 10 ** 6
+
+
+class CofferStore:
+    def __init__(self, path=COFFER_DB, *, loop=None, sync_interval=COFFER_SYNC_INTERVAL):
+        """Keeps a local, indexed copy of the nation coffer history"""
+        self.path = path
+        self.loop = loop
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.last_sync = {}
+        self.sync_locks = {}
+
+    def run(self, func, *args):
+        """Runs a blocking database function in the executor"""
+        loop = self.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, func, *args)
+
+    def latest_timestamp(self, nation_id):
+        with self.lock:
+            row = self.db.execute('SELECT MAX(timestamp) FROM coffer_history WHERE nation_id = ?',
+                                  (nation_id,)).fetchone()
+        return row[0]
+
+    def insert(self, nation_id, history):
+        """Stores API history entries, ignoring any that are already stored"""
+        rows = [(nation_id, int(h['Timestamp']), h['Description'],
+                 (h.get('Metadata') or {}).get('PlayerName') or '',
+                 int(h['NationCoffers']), json.dumps(h.get('Metadata')))
+                for h in reversed(history)]  # oldest first so rowid follows time
+        with self.lock, self.db:
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO coffer_history VALUES (?, ?, ?, ?, ?, ?)', rows)
+            return self.db.total_changes - before
+
+    def recent(self, nation_id, limit, offset=0):
+        """Returns history entries newest first, in the shape the Atlas API uses"""
+        with self.lock:
+            rows = self.db.execute('SELECT timestamp, description, coffers, metadata FROM coffer_history '
+                                   'WHERE nation_id = ? ORDER BY timestamp DESC, rowid DESC LIMIT ? OFFSET ?',
+                                   (nation_id, limit, offset)).fetchall()
+        return [{'Timestamp': t, 'Description': d, 'NationCoffers': c, 'Metadata': json.loads(m) if m else None}
+                for t, d, c, m in rows]
+
+    def series(self, nation_id, since=None):
+        """Returns the timestamps and coffer totals newest first, only those from since on if given
+
+        since is in epoch seconds and is scaled to the unit Atlas stamped the
+        history in, so the range is read straight off the time index."""
+        query = 'SELECT timestamp, coffers FROM coffer_history WHERE nation_id = ?'
+        params = [nation_id]
+        if since is not None:
+            query += ' AND timestamp >= ?'
+            params.append(since * timestamp_scale(self.latest_timestamp(nation_id)))
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY timestamp DESC, rowid DESC', params).fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows]
+
+    async def sync(self, client, nation_id, force=False):
+        """Downloads only the history newer than what is already stored"""
+        lock = self.sync_locks.setdefault(nation_id, asyncio.Lock())
+        async with lock:
+            now = (self.loop or asyncio.get_event_loop()).time()
+            last = self.last_sync.get(nation_id)
+            if not force and last is not None and now - last < self.sync_interval:
+                return 0
+            latest = await self.run(self.latest_timestamp, nation_id)
+            params = {'MinTime': latest or 0, 'NationId': nation_id}
+            coffers = await client.authed_json('/nation/v2/api/getcofferlog', params=params)
+            added = await self.run(self.insert, nation_id, coffers['Data']['CofferHistory'])
+            self.last_sync[nation_id] = now
+            return added
+
+    def close(self):
+        with self.lock:
+            self.db.close()
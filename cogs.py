@@ -1,29 +1,29 @@
 from discord.ext import commands
 from pathlib import Path
-from bs4 import BeautifulSoup
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from matplotlib import style
 from io import BytesIO
-from mcstatus import MinecraftServer
+from atlas import AtlasClient, LeaderboardIndex
+from coffers import CofferStore
+from charts import ChartRenderer, render_coffers, parse_duration, COFFER_GRAPH_POINTS
+from watchdog import LoopWatchdog
 import datetime
-import requests
 import humanize
+import asyncio
+import time
 import discord
+import lazyimport
+import metrics
 import inspect
-import os
+import logging
 
 
 RULES_CHANNEL_ID = 554695025485807647
 GOV_DOCS_CHANNEL_ID = 553795615042306079
 LORD_ROLE_ID = 553616009572122625
 MY_ID = 206079414709125120
-ATLAS_USER = os.environ.get('ATLAS_USER')
-ATLAS_PASS = os.environ.get('ATLAS_PASS')
 BLOTHERA_KINGDOM_ID = 277
+COFFER_LOG_PAGE = 500  # history entries read per query while filling the player log
 
-
-style.use('dark_background')
+log = logging.getLogger(__name__)
 
 
 async def is_lord(ctx):
@@ -40,7 +40,69 @@ class General(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.bot.remove_command("help")
-    
+        self.usages = None
+        self.aliases = None
+        self.command_embeds = None
+        self.help_embed = None
+        self.metrics_server = None
+        if metrics.METRICS_PORT:
+            self.metrics_server = metrics.MetricsServer()
+            self.bot.loop.create_task(self.metrics_server.start())
+        self.watchdog = LoopWatchdog(self.bot.loop)
+        self.watchdog.start()
+        self.bot.before_invoke(self.before_command)
+        self.bot.after_invoke(self.after_command)
+
+    def cog_unload(self):
+        self.watchdog.stop()
+        if self.metrics_server is not None:
+            self.bot.loop.create_task(self.metrics_server.close())
+
+    def build_metadata(self):
+        """Precomputes usage strings, help embeds and the alias table, rebuilt whenever extensions change"""
+        usages = {}
+        aliases = {}
+        command_embeds = {}
+        for command in self.bot.walk_commands():
+            name = command.qualified_name
+            usages[name] = self.get_usage(command)
+            parent = command.full_parent_name
+            for alias in [command.name] + list(command.aliases):
+                aliases[f"{parent} {alias}".strip()] = name
+
+            embed = discord.Embed(title=command.name, colour=0xc62323)
+            desc = command.description
+            embed.description = desc if desc != "" else command.callback.__doc__
+            alias_list = ", ".join(f"`{c}`" for c in command.aliases)
+            if alias_list:
+                embed.add_field(name="Aliases", value=alias_list)
+            embed.add_field(name="Usage", value=f"`{usages[name]}`")
+            command_embeds[name] = embed
+
+        help_embed = discord.Embed(title="Commands are listed below", colour=0xc62323)
+        help_embed.description = f"Type `{self.bot.command_prefix}help <command>` for more information"
+        if self.bot.user is not None:
+            avatar = self.bot.user.avatar_url_as(format='png', static_format='png')
+            help_embed.set_author(name=self.bot.user.name, icon_url=avatar)
+            help_embed.set_thumbnail(url=avatar)
+        for cog_name, cog in self.bot.cogs.items():
+            cmds = [c for c in cog.get_commands() if not c.hidden]
+            if cmds:
+                help_embed.add_field(name=cog_name, value="\n".join(f"`{c.name}`" for c in cmds))
+
+        self.usages, self.aliases, self.command_embeds = usages, aliases, command_embeds
+        self.help_embed = help_embed
+
+    def ensure_metadata(self):
+        if self.usages is None:
+            self.build_metadata()
+
+    def usage(self, command):
+        """Looks up the precomputed usage string of a command"""
+        self.ensure_metadata()
+        usage = self.usages.get(command.qualified_name)
+        return usage if usage is not None else self.get_usage(command)
+
     def get_usage(self, command):
         args_spec = inspect.getfullargspec(command.callback)  # Get arguments of command
         args_info = []
@@ -71,37 +133,27 @@ class General(commands.Cog):
     @commands.command(aliases=["h"])
     async def help(self, ctx, cmd=None):
         """Shows you a list of commands"""
+        self.ensure_metadata()
         if cmd is None:
-            help_embed = discord.Embed(title="Commands are listed below", colour=0xc62323)
-            help_embed.__setattr__("description", "Type `{}help <command>` for more information".format(self.bot.command_prefix))
-            help_embed.set_author(name=self.bot.user.name, icon_url=self.bot.user.avatar_url_as(format='png', static_format='png'))
-            help_embed.set_thumbnail(url=self.bot.user.avatar_url_as(format='png', static_format='png'))
-            for cog_name, cog in self.bot.cogs.items():
-                cmds = cog.get_commands()
-                if cmds:
-                    help_embed.add_field(name=cog_name, value="\n".join("`{0.name}`".format(c) for c in cmds if not c.hidden))
-            await ctx.author.send(embed=help_embed)
+            await ctx.author.send(embed=self.help_embed)
             await ctx.message.add_reaction("\U0001F4EC")
         else:
-            command = self.bot.get_command(cmd)
-            if command is None:
-                ctx.send("That command does not exist")
+            name = self.aliases.get(cmd)
+            if name is None:
+                await ctx.send("That command does not exist")
             else:
-                help_embed = discord.Embed(title=command.name, colour=0xc62323)
-                desc = command.description
-                help_embed.description = desc if desc != "" else command.callback.__doc__
-                aliases = ", ".join("`{}`".format(c) for c in command.aliases)
-                if len(aliases) > 0:
-                    help_embed.add_field(name="Aliases", value=aliases)
-                usage = self.get_usage(command)
-                help_embed.add_field(name="Usage", value="`" + usage + "`")
-                await ctx.send(embed=help_embed)
+                await ctx.send(embed=self.command_embeds[name])
 
     @commands.command(hidden=True)
     @commands.is_owner()
     async def reload(self, ctx, plugin):
         """Reloads all plugins or a specific plugin"""
+        start = time.perf_counter()
         self.bot.reload_extension(plugin)
+        lazyimport.record_extension(plugin, time.perf_counter() - start)
+        general = self.bot.get_cog("General")  # a new instance if this extension was reloaded
+        if general is not None:
+            general.build_metadata()
 
     @commands.command(name="eval", hidden=True)
     @commands.is_owner()
@@ -117,19 +169,48 @@ class General(commands.Cog):
         except Exception as e:
             await ctx.send("```python\n{}```".format(e))
 
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def stats(self, ctx, action=None):
+        """Shows command and upstream latencies or resets them"""
+        if action == "reset":
+            metrics.clear()
+            return await ctx.send("Metrics have been reset")
+        report = metrics.summary() or "No metrics recorded yet"
+        await ctx.send(f"```{report[:1990]}```")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def lag(self, ctx):
+        """Shows rolling event loop lag percentiles"""
+        await ctx.send("```" + "\n".join(f"{k}: {v}" for k, v in self.watchdog.stats().items()) + "```")
+
+    async def before_command(self, ctx):
+        """Runs in the command's own task right before its callback, unlike the on_command event"""
+        ctx.started = time.perf_counter()
+        await self.watchdog.command_started(ctx)
+
+    async def after_command(self, ctx):
+        """Runs once the callback returns or raises"""
+        metrics.observe("command_seconds", time.perf_counter() - ctx.started, command=ctx.command.qualified_name)
+        await self.watchdog.command_finished(ctx)
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx, exception):
+        if ctx.command is not None:
+            metrics.increment("command_errors_total", command=ctx.command.qualified_name,
+                              error=type(exception).__name__)
         if type(exception) == discord.ext.commands.errors.CommandNotFound:
             return
         error_embed = discord.Embed(colour=0xFF0000)
         if type(exception) == discord.ext.commands.errors.MissingRequiredArgument:
             arg = str(exception).split()[0]
             error_embed.title = "Syntax Error"
-            error_embed.description = "Usage: `{}`".format(self.get_usage(ctx.command))
+            error_embed.description = "Usage: `{}`".format(self.usage(ctx.command))
             error_embed.set_footer(text="{} is a required argument".format(arg))
         elif type(exception) == discord.ext.commands.errors.BadArgument:
             error_embed.title = "Syntax Error"
-            error_embed.description = "Usage: `{}`".format(self.get_usage(ctx.command))
+            error_embed.description = "Usage: `{}`".format(self.usage(ctx.command))
             error_embed.set_footer(text=str(exception))
         else:
             error_embed.title = "Error"
@@ -141,6 +222,9 @@ class General(commands.Cog):
     async def on_ready(self):
         game = discord.Activity(name='the Kingdom', type=discord.ActivityType.watching)
         await self.bot.change_presence(activity=game)
+        self.build_metadata()
+        await lazyimport.warm(self.bot.loop)
+        log.info('Startup timings:\n%s', lazyimport.report())
 
 
 class Welcome(commands.Cog):
@@ -160,12 +244,23 @@ class Atlas(commands.Cog):
     
     def __init__(self, bot):
         self.bot = bot
+        self.atlas = AtlasClient(loop=self.bot.loop)
+        self.leaderboards = LeaderboardIndex(self.atlas, loop=self.bot.loop)
+        self.leaderboard_task = self.bot.loop.create_task(self.leaderboards.run())
+        self.coffers = CofferStore(loop=self.bot.loop)
+        self.charts = ChartRenderer(loop=self.bot.loop)
+
+    def cog_unload(self):
+        self.leaderboard_task.cancel()
+        self.bot.loop.create_task(self.atlas.close())
+        self.coffers.close()
+        self.charts.close()
 
     @commands.command()
     async def nations(self, ctx, *, name: str=''):
         """Gets information on the nations of Atlas"""
         if not name:
-            response = requests.get('https://mc-atlas.com/nation/api/nation/list').json()
+            response = await self.atlas.cached_json('/nation/api/nation/list')
             if response['Status'] == 'OK':
                 nations_names = [nation['nationName'] for nation in response['Data']['nationList'] if not nation.get('nationIsAdmin')]
                 
@@ -176,7 +271,7 @@ class Atlas(commands.Cog):
             else:
                 await ctx.send('*Hmmm, I can\'t seem to find our records at the moment, check back later!')
         else:
-            response = requests.get('https://mc-atlas.com/nation/api/nation/list', params={'ShowCitizens': True, 'ShowTowns': True}).json()
+            response = await self.atlas.cached_json('/nation/api/nation/list', params={'ShowCitizens': 'True', 'ShowTowns': 'True'})
             if response['Status'] == 'OK':
                 for nation in filter(lambda x: not x.get('nationIsAdmin'), response['Data']['nationList']):
                     if nation['nationName'].lower().strip() == name.lower().strip():
@@ -215,127 +310,96 @@ class Atlas(commands.Cog):
     async def leaderboard(self, ctx, *, category='top nation'):
         """Retrieves the Atlas leaderboard"""
         loading_message = await ctx.send(f'Searching for `{category.title()}` leaderboard...')
-        leaderboard_urls = ['Overall', 'Military', 'Industry', 'Technology', 'Culture', 'Misc']
-        leaderboard = None
-        for url in leaderboard_urls:
-            response = requests.get('https://www.mc-atlas.com/leaderboards/' + url)
-            soup = BeautifulSoup(response.text, 'lxml')
-            if category.lower() == 'top' or category.lower() == 'top nation':
-                leaderboard = soup.findAll('div', class_='large-leaderboard')
-            elif url == 'Overall':
-                leaderboard = [x for x in soup.findAll('div', class_='leaderboard-mini') if x.select_one('h1').text.lower() == category.lower()]
-            else:
-                leaderboard = [x for x in soup.findAll('div', class_='normal-leaderboard') if x.select_one('h1').text.lower() == category.lower()]
-            if leaderboard:
-                leaderboard = leaderboard[0]
-                break
-        else:
+        try:
+            leaderboard = await self.leaderboards.get(category)
+        except asyncio.TimeoutError:
+            return await ctx.send('*Hmmm, I can\'t seem to find the leaderboards at the moment, check back later!*')
+        if leaderboard is None:
             return await ctx.send('*I couldn\'t find any leaderboards by that category...\n'
                                   'Go to https://www.mc-atlas.com/leaderboards/Overall to view the leaderboard names*')
-            leaderboard = leaderboard[0]
-        nations_lis = leaderboard.findAll('li')
-        nations = [(n.select_one('mark').text, n.select_one('small').text) for n in nations_lis if n.select_one('mark').text != '-']
 
-        embed = discord.Embed(description='\n'.join(f'**{i}.** {n[0]} - {n[1]}' for i, n in enumerate(nations, start=1)), colour=0xEAEE57)
-        embed.set_author(name=leaderboard.select_one('h1').text, icon_url='https://www.mc-atlas.com' + leaderboard.select_one('img')['src'])
+        embed = discord.Embed(description='\n'.join(f'**{i}.** {n[0]} - {n[1]}' for i, n in enumerate(leaderboard.rows, start=1)), colour=0xEAEE57)
+        embed.set_author(name=leaderboard.title, icon_url=leaderboard.icon_url)
         await loading_message.edit(content='*This is the current leaderboard according to our records...*', embed=embed)
 
-    async def atlas_login(self):
-        session = requests.Session()
-        login_page = session.get('https://mc-atlas.com/user/login')
-        soup = BeautifulSoup(login_page.text, 'lxml')
-
-        form_build_id = soup.select_one('input[name=form_build_id]')['value']
-        form_id = soup.select_one('input[name=form_id]')['value']
-        op = soup.select_one('input[name=op]')['value']
-
-        data = {'name': ATLAS_USER,
-                'pass': ATLAS_PASS,
-                'form_build_id': form_build_id,
-                'form_id': form_id,
-                'op': op}
-
-        login_request = session.post('https://mc-atlas.com/user/login', data=data,
-                                     allow_redirects=False)
-        
-        return session
-
-    async def get_town_info(self, town_name, session=None):
-        if not session:
-            session = await self.atlas_login()
-        towns = session.get('https://www.mc-atlas.com/nation/v2/api/currentusernation').json()['Data']['nation']['towns']
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def atlascache(self, ctx, action=None):
+        """Shows the Atlas cache and request coalescing statistics or flushes the cache"""
+        if action == 'flush':
+            self.atlas.cache.clear()
+            return await ctx.send('The Atlas cache has been flushed')
+        stats = dict(self.atlas.cache.stats(), **self.atlas.flights.stats())
+        await ctx.send('```' + '\n'.join(f'{k}: {v}' for k, v in stats.items()) + '```')
+
+    async def get_town_info(self, town_name):
+        towns = (await self.atlas.authed_json('/nation/v2/api/currentusernation'))['Data']['nation']['towns']
         try:
             town = [t for t in towns if t['townName'].lower() == town_name.lower()][0]
         except IndexError:
             return None
         town_id = town['townId']
-        town_response = session.get('https://www.mc-atlas.com/nation/v2/api/towninfo', params={'TownId': town_id}).json()
+        town_response = await self.atlas.authed_json('/nation/v2/api/towninfo', params={'TownId': town_id})
         return town_response['Data']
 
     async def get_coffers_log(self):
-        session = await self.atlas_login()
-
-        params = {'MinTime': 0, 'NationId': BLOTHERA_KINGDOM_ID}
-        coffers = session.get('https://mc-atlas.com/nation/v2/api/getcofferlog', params=params).json()
-        history = coffers['Data']['CofferHistory']
+        await self.coffers.sync(self.atlas, BLOTHERA_KINGDOM_ID)
+        history = []
+        exhausted = False
         nice_logs = []
         char_count = 0
-        for n, log in enumerate(history):
-            if 'Player' in log['Description']:
-                dt = datetime.datetime.fromtimestamp(int(str(log['Timestamp'])[:10])).strftime('%d/%m/%y')
-                player = log["Metadata"]["PlayerName"].replace('__', '\_\_')
-                total = log["NationCoffers"]
+        n = 0
+        while True:
+            if n + 1 >= len(history):  # the delta needs the entry after this one
+                if exhausted:
+                    break
+                page = await self.coffers.run(self.coffers.recent, BLOTHERA_KINGDOM_ID, COFFER_LOG_PAGE, len(history))
+                exhausted = len(page) < COFFER_LOG_PAGE
+                history.extend(page)
+                continue
+            entry = history[n]
+            if 'Player' in entry['Description']:
+                dt = datetime.datetime.fromtimestamp(int(str(entry['Timestamp'])[:10])).strftime('%d/%m/%y')
+                player = entry["Metadata"]["PlayerName"].replace('__', '\_\_')
+                total = entry["NationCoffers"]
                 delta = abs(int(total) - int(history[n+1]['NationCoffers']))
-                if log['Description'] == 'Player Deposit':
+                if entry['Description'] == 'Player Deposit':
                     nice_logs.append(f'**{dt} >** {player} added {delta} to the coffers ({total})')
                     char_count += len(f'**{dt} >** {player} added {delta} to the coffers ({total})')
-                elif log['Description'] == 'Player Withdraw':
+                elif entry['Description'] == 'Player Withdraw':
                     nice_logs.append(f'**{dt} >** {player} removed {delta} from the coffers ({total})')
                     char_count += len(f'**{dt} >** {player} removed {delta} from the coffers ({total})')
             if char_count > 1850:
-                print(char_count)
+                log.debug('Coffer log truncated at %d characters', char_count)
                 nice_logs.pop(-1)
                 break
-        
-        return '**Blothera Coffers (Players Only)**\n' + '\n'.join(nice_logs)
+            n += 1
 
+        return '**Blothera Coffers (Players Only)**\n' + '\n'.join(nice_logs)
 
-    async def get_coffers_graph(self):
-        session = await self.atlas_login()
-        
-        params = {'MinTime': 0, 'NationId': BLOTHERA_KINGDOM_ID}
-        coffers = session.get('https://mc-atlas.com/nation/v2/api/getcofferlog', params=params).json()
-
-        history = coffers['Data']['CofferHistory']
-        coffer_logs = [h['NationCoffers'] for h in history]
-        date_logs = [datetime.datetime.fromtimestamp(int(str(h['Timestamp'])[:10])) for h in history]
-
-        fig = plt.figure()
-
-        ax = fig.add_subplot(111)
-
-        ax.set_title('Kingdom of Blothera Coffers')
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Coffers')
-        ax.plot(date_logs, coffer_logs, label='Coffers')
-
-        loc = mdates.AutoDateLocator()
-        loc.intervald[mdates.HOURLY] = [24]
-        ax.xaxis.set_major_locator(loc)
-        fmter = mdates.DateFormatter('%d/%m/%Y')
-        ax.xaxis.set_major_formatter(fmter)
 
-        image = BytesIO()
-        fig.savefig(image, format='png', transparent=True)
-        image.seek(0)
-        return coffer_logs[0], image
+    async def get_coffers_graph(self, duration=None):
+        await self.coffers.sync(self.atlas, BLOTHERA_KINGDOM_ID)
+        latest = (await self.coffers.run(self.coffers.recent, BLOTHERA_KINGDOM_ID, 1))[0]
+        key = ('coffers', latest['Timestamp'], duration)
+        image = self.charts.cached(key)
+        if image is None:
+            since = int(time.time()) - duration if duration else None
+            timestamps, coffer_logs = await self.coffers.run(self.coffers.series, BLOTHERA_KINGDOM_ID, since)
+            image = await self.charts.render(key, render_coffers, timestamps, coffer_logs, since, COFFER_GRAPH_POINTS)
+        return latest['NationCoffers'], BytesIO(image)
 
     @commands.command()
     @commands.check(is_lord)
     async def blothera(self, ctx, *, request):
         """Retrieves information on Blothera (Lords only)"""
-        if request.lower() == 'coffers':
-            amount, coffer_graph = await self.get_coffers_graph()
+        if request.split()[0].lower() == 'coffers':
+            duration = None
+            if len(request.split()) > 1:
+                duration = parse_duration(request.split(None, 1)[1])
+                if duration is None:
+                    return await ctx.send('Please enter a range such as `12h`, `30d`, `2w`, `6m` or `1y`')
+            amount, coffer_graph = await self.get_coffers_graph(duration)
             await ctx.send(content=f'*The nation\'s coffers currently stands at {amount:,}*', file=discord.File(coffer_graph, filename='blothera_coffers.png'))
         elif request.lower() == 'playerlogs':
             logs = await self.get_coffers_log()
@@ -346,11 +410,10 @@ class Atlas(commands.Cog):
             except IndexError:
                 await ctx.send('Please enter the town name')
             else:
-                session = await self.atlas_login()
-                town_info = await self.get_town_info(town_name, session=session)
+                town_info = await self.get_town_info(town_name)
             
                 embed = discord.Embed(title=town_info['townName'], colour=0xc62323)
-                map_file = BytesIO(session.get('https://www.mc-atlas.com/nation/v2'+town_info['map']['url'][1:]).content)
+                map_file = BytesIO(await self.atlas.authed_bytes('/nation/v2'+town_info['map']['url'][1:]))
                 await ctx.send(content='**'+town_info['townName']+'**', file=discord.File(map_file, filename='town.png'))
             
 
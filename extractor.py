@@ -0,0 +1,208 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from lazyimport import lazy_import
+from singleflight import SingleFlight
+import metrics
+import asyncio
+import queue
+import time
+import os
+import re
+
+
+EXTRACTOR_WORKERS = int(os.environ.get('EXTRACTOR_WORKERS', 3))
+EXTRACTOR_TIMEOUT = int(os.environ.get('EXTRACTOR_TIMEOUT', 30))  # per extraction, once a worker picks it up
+EXTRACTOR_QUEUE_TIMEOUT = int(os.environ.get('EXTRACTOR_QUEUE_TIMEOUT', 300))  # waiting for a free worker
+STREAM_CACHE_SIZE = int(os.environ.get('STREAM_CACHE_SIZE', 512))
+STREAM_REFRESH_MARGIN = int(os.environ.get('STREAM_REFRESH_MARGIN', 300))
+STREAM_DEFAULT_LIFETIME = 3600  # used when a media url carries no expire parameter
+
+youtube_dl = lazy_import('youtube_dl')
+
+
+def video_id(url):
+    """Gets the YouTube video ID of a url or bare ID, falls back to the url itself"""
+    match = re.search(r'(?:v=|youtu\.be/|^)([\w-]{11})(?:$|[&?#])', url)
+    return match.group(1) if match else url
+
+
+def stream_expiry(url):
+    """Reads the expire timestamp out of a googlevideo media url, returns None if there isn't one"""
+    match = re.search(r'[?&/]expire[=/](\d+)', url or '')
+    return int(match.group(1)) if match else None
+
+
+class Track:
+    __slots__ = ('video_id', 'title', 'duration', 'thumbnail', 'webpage_url', 'stream_url', 'expire', 'codec')
+
+    def __init__(self, video_id, title, duration, thumbnail, webpage_url, stream_url, expire, codec=None):
+        """The parts of a youtube_dl info dict the bot actually uses"""
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.thumbnail = thumbnail
+        self.webpage_url = webpage_url
+        self.stream_url = stream_url
+        self.expire = expire
+        self.codec = codec
+
+    @classmethod
+    def from_info(cls, info, video_id=None):
+        """Builds a track from an extract_info result, the info dict can be dropped afterwards"""
+        stream_url = info.get('url')
+        expire = stream_expiry(stream_url) or int(time.time()) + STREAM_DEFAULT_LIFETIME
+        return cls(video_id or info.get('id'), info.get('title'), int(info.get('duration') or 0),
+                   info.get('thumbnail'), info.get('webpage_url'), stream_url, expire, info.get('acodec'))
+
+    def __repr__(self):
+        return '<Track: {0.video_id} {0.title!r}>'.format(self)
+
+
+class ExtractorPool:
+    def __init__(self, options, *, loop, workers=EXTRACTOR_WORKERS, timeout=EXTRACTOR_TIMEOUT,
+                 queue_timeout=EXTRACTOR_QUEUE_TIMEOUT, audio_cache=None):
+        """Resolves video metadata on a dedicated pool of reusable YoutubeDL instances
+
+        Requests are queued per guild and dispatched round-robin, so a guild
+        queuing many songs can't starve metadata resolution for other guilds.
+        Videos held in the audio cache are resolved without extraction."""
+        self.options = dict(options, socket_timeout=timeout)
+        self.loop = loop
+        self.workers = workers
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.audio_cache = audio_cache
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.instances = queue.LifoQueue()
+        self.created = 0
+        self.pending = OrderedDict()
+        self.active = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.streams = OrderedDict()
+        self.resolving = SingleFlight('resolve', loop=loop)
+        self.stream_hits = 0
+        self.stream_misses = 0
+        self.stream_refreshes = 0
+
+    def _get_instance(self):
+        """Takes an idle YoutubeDL instance, creating one if the pool isn't full yet"""
+        try:
+            return self.instances.get_nowait()
+        except queue.Empty:
+            self.created += 1
+            return youtube_dl.YoutubeDL(self.options)
+
+    def _extract(self, url):
+        """Runs on a worker thread, each instance is used by one thread at a time"""
+        ytdl = self._get_instance()
+        try:
+            with metrics.timer('extract_seconds'):
+                return ytdl.extract_info(url, download=False)
+        finally:
+            self.instances.put(ytdl)
+
+    async def extract(self, url, *, key=None):
+        """Resolves a url's metadata, key is used to queue fairly between guilds"""
+        future = self.loop.create_future()
+        self.pending.setdefault(key, deque()).append((url, future))
+        self._dispatch()
+        try:
+            # the extraction timeout itself starts in _dispatch, this only bounds the whole wait
+            return await asyncio.wait_for(future, self.queue_timeout + self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def is_fresh(self, expire):
+        """Checks whether a stream expiring at expire can still be played for a while"""
+        return expire is not None and time.time() < expire - STREAM_REFRESH_MARGIN
+
+    def is_playable(self, track):
+        """Checks whether a track can be played without resolving it again"""
+        if self.audio_cache is not None and track.video_id in self.audio_cache:
+            return True
+        return self.is_fresh(track.expire)
+
+    async def resolve(self, url, *, key=None):
+        """Resolves a url to a Track, shared between every guild playing the same video"""
+        vid = video_id(url)
+        entry = self.streams.get(vid)
+        if entry is not None and self.is_fresh(entry.expire):
+            self.streams.move_to_end(vid)
+            self.stream_hits += 1
+            return entry
+        if self.audio_cache is not None:
+            cached = self.audio_cache.track(vid)
+            if cached is not None:
+                return cached
+
+        if vid not in self.resolving:
+            if entry is None:
+                self.stream_misses += 1
+            else:
+                self.stream_refreshes += 1
+        return await self.resolving.do(vid, lambda: self._resolve(url, vid, key))
+
+    async def _resolve(self, url, vid, key):
+        info = await self.extract(url, key=key)
+        entry = self.streams[vid] = Track.from_info(info, vid)
+        self.streams.move_to_end(vid)
+        while len(self.streams) > STREAM_CACHE_SIZE:
+            self.streams.popitem(last=False)
+        return entry
+
+    def _dispatch(self):
+        """Starts queued jobs round-robin across guilds while workers are free"""
+        while self.active < self.workers and self.pending:
+            key, jobs = next(iter(self.pending.items()))
+            url, future = jobs.popleft()
+            if jobs:
+                self.pending.move_to_end(key)
+            else:
+                del self.pending[key]
+            if future.done():  # cancelled or timed out while queued
+                continue
+            self.active += 1
+            timer = self.loop.call_later(self.timeout, self._expire, future)
+            job = self.loop.run_in_executor(self.executor, self._extract, url)
+            job.add_done_callback(lambda job, future=future, timer=timer: self._finished(job, future, timer))
+
+    def _expire(self, future):
+        """Fails an extraction that has been running on a worker for longer than the timeout"""
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError())
+
+    def _finished(self, job, future, timer):
+        timer.cancel()
+        self.active -= 1
+        self.completed += 1
+        if not future.done():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self._dispatch()
+
+    def stats(self):
+        """Returns a dictionary of pool statistics"""
+        return {'workers': self.workers,
+                'instances': self.created,
+                'active': self.active,
+                'queued': sum(len(jobs) for jobs in self.pending.values()),
+                'queued guilds': len(self.pending),
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'cached streams': len(self.streams),
+                'stream hits': self.stream_hits,
+                'stream misses': self.stream_misses,
+                'stream refreshes': self.stream_refreshes}
+
+    def close(self):
+        for jobs in self.pending.values():
+            for url, future in jobs:
+                future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=False)
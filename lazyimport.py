@@ -0,0 +1,91 @@
+import importlib
+import threading
+import logging
+import time
+import sys
+
+
+log = logging.getLogger(__name__)
+
+import_times = {}
+extension_times = {}
+setup_hooks = {}
+deferred = []
+_loaded = set()
+_locks = {}  # module name -> lock, so warming one module never blocks importing another
+_locks_lock = threading.Lock()
+
+
+def _module_lock(name):
+    with _locks_lock:
+        lock = _locks.get(name)
+        if lock is None:
+            lock = _locks[name] = threading.RLock()
+        return lock
+
+
+def timed_import(name):
+    """Imports a module and runs its setup hook, recording how long the first import took"""
+    if name in _loaded:
+        return sys.modules[name]
+    parent = name.rpartition('.')[0]
+    if parent:
+        timed_import(parent)  # before taking our own lock, so locks are never nested
+    with _module_lock(name):
+        if name in _loaded:
+            return sys.modules[name]
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        hook = setup_hooks.get(name)
+        if hook is not None:
+            hook(module)
+        import_times[name] = time.perf_counter() - start
+        _loaded.add(name)
+    return module
+
+
+class LazyModule:
+    def __init__(self, name):
+        """Stands in for a module until one of its attributes is used"""
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(timed_import(self._name), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._name in _loaded else 'deferred'
+        return '<LazyModule: {} ({})>'.format(self._name, state)
+
+
+def lazy_import(name, setup=None):
+    """Returns a proxy that imports the module on first use"""
+    if setup is not None:
+        setup_hooks[name] = setup
+    if name not in deferred:
+        deferred.append(name)
+    return LazyModule(name)
+
+
+async def warm(loop):
+    """Imports every deferred module in the background so the first command doesn't pay for it"""
+    for name in list(deferred):
+        if name not in _loaded:
+            try:
+                await loop.run_in_executor(None, timed_import, name)
+            except ImportError:
+                log.warning('Could not import %s', name)
+
+
+def record_extension(name, seconds):
+    extension_times[name] = seconds
+    log.info('Loaded extension %s in %.0fms', name, seconds * 1000)
+
+
+def report():
+    """Returns a summary of extension load and dependency import times"""
+    lines = ['extension {}: {:.0f}ms'.format(name, seconds * 1000)
+             for name, seconds in extension_times.items()]
+    lines.extend('import {}: {:.0f}ms'.format(name, seconds * 1000)
+                 for name, seconds in sorted(import_times.items(), key=lambda i: i[1], reverse=True))
+    lines.extend('import {}: deferred'.format(name) for name in deferred if name not in _loaded)
+    return '\n'.join(lines)
@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from lazyimport import lazy_import
+import threading
+import asyncio
+import logging
+import bisect
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # 0 disables the HTTP endpoint
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+web = lazy_import('aiohttp.web')
+
+histograms = {}
+counters = {}
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Cumulative latency histogram in the Prometheus layout"""
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating inside the bucket it falls in"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    """Records a latency in the histogram called name"""
+    key = _key(name, labels)
+    with _lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+def increment(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+@contextmanager
+def timer(name, **labels):
+    """Times a block into the histogram called name, counting exceptions in errors_total"""
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        increment('errors_total', source=name, error=type(e).__name__)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def clear():
+    with _lock:
+        histograms.clear()
+        counters.clear()
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+def render_prometheus():
+    """Returns every metric in the Prometheus text exposition format"""
+    with _lock:
+        histogram_items = sorted((key, (list(h.counts), h.sum, h.count, h.buckets))
+                                 for key, h in histograms.items())
+        counter_items = sorted(counters.items())
+
+    lines = []
+    typed = set()
+    for (name, labels), (counts, total, count, buckets) in histogram_items:
+        if name not in typed:
+            lines.append('# TYPE {} histogram'.format(name))
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            lines.append('# TYPE {} counter'.format(name))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def summary():
+    """Returns a human readable summary of latencies and counters, slowest first"""
+    with _lock:
+        rows = [('{}{}'.format(name, _labels(labels)), h.count, h.quantile(0.5), h.quantile(0.95), h.sum / h.count)
+                for (name, labels), h in histograms.items() if h.count]
+        counter_rows = sorted(('{}{}'.format(name, _labels(labels)), value) for (name, labels), value in counters.items())
+    rows.sort(key=lambda row: row[3], reverse=True)
+    lines = ['{} n={} p50={:.0f}ms p95={:.0f}ms mean={:.0f}ms'.format(name, count, p50 * 1000, p95 * 1000, mean * 1000)
+             for name, count, p50, p95, mean in rows]
+    lines.extend('{} {}'.format(name, value) for name, value in counter_rows)
+    return '\n'.join(lines)
+
+
+class MetricsServer:
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        """Serves /metrics over HTTP for Prometheus to scrape"""
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request):
+        return web.Response(text=render_prometheus(), content_type='text/plain')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        log.info('Serving metrics on http://%s:%d/metrics', self.host, self.port)
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,340 @@
+from collections import deque
+from itertools import islice
+import random
+
+
+class IndexedSequence:
+    def __init__(self, items=()):
+        """An ordered sequence of unique ints, indexed by a Fenwick tree over live positions once it has holes
+
+        Appends and pops from the front are amortised O(1). While nothing has
+        been removed from the middle the live entries are one contiguous slice,
+        so positional lookup, rank and slicing are plain list operations.
+        Removals from the middle leave tombstones. The tree is built on the
+        first lookup that needs it, then kept up to date in O(log n) per
+        change. Tombstones are compacted away once they make up half the array."""
+        self._build(list(items))
+
+    def _build(self, items):
+        self.items = items
+        self.alive = bytearray(b'\x01') * len(items)
+        self.positions = {item: pos for pos, item in enumerate(items)}
+        self.tree = None
+        self.head = 0
+        self.holes = 0  # tombstones at or after head
+        self.skipped = 0  # popped positions the tree still counts as alive
+        self.size = len(items)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def _index(self):
+        """Builds the Fenwick tree over the alive flags if it doesn't exist yet"""
+        if self.tree is None:
+            n = len(self.items)
+            tree = [0]
+            tree.extend(self.alive)
+            for i in range(1, n + 1):
+                j = i + (i & -i)
+                if j <= n:
+                    tree[j] += tree[i]
+            self.tree = tree
+            self.skipped = 0
+        return self.tree
+
+    def _prefix(self, pos):
+        """Counts the positions before pos that the tree considers alive"""
+        tree = self._index()
+        total = 0
+        while pos > 0:
+            total += tree[pos]
+            pos -= pos & -pos
+        return total
+
+    def _find(self, target):
+        """Finds the position holding the target-th (1-based) alive entry of the tree"""
+        tree = self._index()
+        idx = 0
+        n = len(self.items)
+        step = 1 << (n.bit_length() - 1) if n else 0
+        while step:
+            nxt = idx + step
+            if nxt <= n and tree[nxt] < target:
+                idx = nxt
+                target -= tree[nxt]
+            step >>= 1
+        return idx
+
+    def append(self, item):
+        tree = self.tree
+        if tree is not None:
+            j = len(self.items) + 1
+            value = 1
+            low = j & -j
+            k = 1
+            while k < low:  # a new node only sums its children, log(lowbit) of them, O(1) on average
+                value += tree[j - k]
+                k <<= 1
+            tree.append(value)
+        self.positions[item] = len(self.items)
+        self.items.append(item)
+        self.alive.append(1)
+        self.size += 1
+
+    def discard(self, item):
+        """Removes an item from anywhere in the sequence"""
+        pos = self.positions.pop(item, None)
+        if pos is None:
+            return
+        self.alive[pos] = 0
+        self.size -= 1
+        self.holes += 1
+        tree = self.tree
+        if tree is not None:
+            i = pos + 1
+            n = len(self.items)
+            while i <= n:
+                tree[i] -= 1
+                i += i & -i
+        self._maybe_compact()
+
+    def first(self):
+        """Returns the first item without removing it, or None"""
+        items, alive = self.items, self.alive
+        while self.head < len(items) and not alive[self.head]:
+            self.head += 1
+            self.holes -= 1
+        if self.head == len(items):
+            return None
+        return items[self.head]
+
+    def popleft(self):
+        item = self.first()
+        if item is None:
+            return None
+        del self.positions[item]
+        self.alive[self.head] = 0
+        self.head += 1
+        if self.tree is not None:
+            self.skipped += 1
+        self.size -= 1
+        self._maybe_compact()
+        return item
+
+    def _maybe_compact(self):
+        if len(self.items) > 64 and self.size * 2 < len(self.items):
+            self._build(list(self))
+
+    def rank(self, item):
+        """Returns the index of item among the live entries"""
+        pos = self.positions[item]
+        if not self.holes:
+            return pos - self.head
+        return self._prefix(pos) - self.skipped
+
+    def kth(self, index):
+        """Returns the live entry at index"""
+        if not 0 <= index < self.size:
+            raise IndexError("queue index out of range")
+        if not self.holes:
+            return self.items[self.head + index]
+        return self.items[self._find(index + self.skipped + 1)]
+
+    def slice(self, start, stop):
+        """Returns the live entries from index start up to stop as a list"""
+        if not self.holes:
+            return self.items[self.head + start:self.head + max(stop, start)]
+        return list(islice(self.iter_from(start), max(stop - start, 0)))
+
+    def iter_from(self, index):
+        if not self.holes:
+            return iter(self.items[self.head + index:])
+        return self._iter_alive(index)
+
+    def _iter_alive(self, index):
+        if index >= self.size:
+            return
+        pos = self._find(index + self.skipped + 1)
+        items, alive = self.items, self.alive
+        for pos in range(pos, len(items)):
+            if alive[pos]:
+                yield items[pos]
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+
+class QueueView:
+    def __init__(self, queue, sequence):
+        """A read-only, list-like view of the songs in one ordering of the queue"""
+        self.queue = queue
+        self.sequence = sequence
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __bool__(self):
+        return len(self.sequence) > 0
+
+    def __iter__(self):
+        songs = self.queue.songs
+        return (songs[entry] for entry in self.sequence)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.sequence.size)
+            if step != 1:
+                return list(self)[index]
+            return list(map(self.queue.songs.__getitem__, self.sequence.slice(start, stop)))
+        if index < 0:
+            index += len(self.sequence)
+        return self.queue.songs[self.sequence.kth(index)]
+
+    def index(self, song):
+        """Returns the position of a song's first entry in this order, in O(log n) per entry"""
+        return self.sequence.rank(self.queue.first_entry(song, self.sequence))
+
+
+class MusicQueue:
+    def __init__(self):
+        """Represents a music queue
+
+        Songs are stored once, by entry number. The play order, the shuffled
+        order and the loop are sequences of entry numbers over the same songs,
+        so shuffling and looping never copy the songs themselves."""
+        self.clear()
+
+    def clear(self):
+        """Clears all playlists"""
+        self.songs = {}
+        self.entries = {}
+        self.next_entry = 0
+        self.normal = IndexedSequence()
+        self.shuffled = None
+        self.looping = None
+
+    def _new_entry(self, song):
+        entry = self.next_entry
+        self.next_entry += 1
+        self.songs[entry] = song
+        self.entries.setdefault(song, deque()).append(entry)
+        return entry
+
+    def _release(self, entry):
+        """Forgets a song entry once no ordering refers to it any more"""
+        if self.looping and entry in self.loop_entries:
+            return
+        song = self.songs.pop(entry)
+        entries = self.entries[song]
+        entries.remove(entry)
+        if not entries:
+            del self.entries[song]
+
+    def _refill(self):
+        """Starts the loop over once the queue has run out"""
+        self.normal = IndexedSequence(self.looping)
+        self.shuffled = IndexedSequence(self.looping) if self.shuffled is not None else None
+
+    def loop(self, *, nowplaying):
+        """Enables or disables looping"""
+        if not self.looping:
+            self.looping = [self._new_entry(nowplaying)] if nowplaying is not None else []
+            self.looping.extend(self.order)
+            self.loop_entries = set(self.looping)
+            if not self.looping:
+                self.looping = None
+            elif not self.order:
+                self._refill()
+        else:
+            self.looping = None
+            for entry in self.loop_entries.difference(self.normal.positions):
+                self._release(entry)
+
+        return bool(self.looping)
+
+    def shuffle(self):
+        """Enables or disables shuffling"""
+        if not self.shuffled:
+            order = list(self.normal)
+            random.shuffle(order)
+            self.shuffled = IndexedSequence(order)
+        else:
+            self.shuffled = None
+
+        return bool(self.shuffled)
+
+    def get_next_song(self):
+        """Gets the next song in the queue, accounts for shuffled queues"""
+        entry = self.order.first()
+        return self.songs[entry] if entry is not None else None
+
+    def first_entry(self, obj, sequence):
+        """Finds the entry of a song that comes first in sequence, a song can be queued more than once"""
+        head = sequence.first()
+        if head is not None and self.songs[head] is obj:  # the common case, the next song playing
+            return head
+        entries = [entry for entry in self.entries.get(obj, ()) if entry in sequence]
+        if not entries:
+            raise ValueError("{!r} is not in the queue".format(obj))
+        return min(entries, key=sequence.rank) if len(entries) > 1 else entries[0]
+
+    def remove(self, obj):
+        """Removes a song from the list, accounts for shuffled and looping queues"""
+        entry = self.first_entry(obj, self.order)
+        for sequence in (self.normal, self.shuffled):
+            if sequence is None:
+                continue
+            if sequence.first() == entry:
+                sequence.popleft()
+            else:
+                sequence.discard(entry)
+        self._release(entry)
+
+        if not self.normal:
+            if self.looping:
+                self._refill()
+            else:
+                self.shuffled = None
+
+    def drop(self, obj):
+        """Removes every entry of a song, from the loop as well, so a song that can't be played isn't retried"""
+        entries = set(self.entries.pop(obj, ()))
+        if not entries:
+            return
+        if self.looping:
+            self.looping = [entry for entry in self.looping if entry not in entries] or None
+            self.loop_entries.difference_update(entries)
+        for entry in entries:
+            self.normal.discard(entry)
+            if self.shuffled:
+                self.shuffled.discard(entry)
+            del self.songs[entry]
+
+        if not self.normal:
+            if self.looping:
+                self._refill()
+            else:
+                self.shuffled = None
+
+    def add(self, obj):
+        """Adds a song to the queue, accounts for shuffled and looping queues"""
+        entry = self._new_entry(obj)
+        self.normal.append(entry)
+        if self.shuffled:
+            self.shuffled.append(entry)
+        if self.looping:
+            self.looping.append(entry)
+            self.loop_entries.add(entry)
+
+    @property
+    def order(self):
+        """Returns the sequence of entries the user sees"""
+        return self.shuffled if self.shuffled else self.normal
+
+    @property
+    def visible(self):
+        """Returns the queue which the user will see"""
+        return QueueView(self, self.order)
@@ -1,24 +1,25 @@
-
 from discord.ext import commands
-import requests
-from bs4 import BeautifulSoup
-import youtube_dl
+from lazyimport import lazy_import
+from webclient import WebClient
+from searchcache import SearchCache, normalize_query
+from singleflight import SingleFlight
+from extractor import ExtractorPool
+from musicqueue import MusicQueue
+from audio import AudioCache, create_source, AUDIO_CACHE_BYTES, AUDIO_PASSTHROUGH
 import datetime
+import metrics
+import logging
 import discord
 import asyncio
 import aiohttp
-import random
 import math
+import time
 import os
 import re
 
 
-if not discord.opus.is_loaded():
-    discord.opus.load_opus('libopus.so')
-
-
 YOUTUBE_DL_OPTIONS = {
-    'format': 'bestaudio',
+    'format': 'bestaudio[acodec=opus]/bestaudio',  # opus can be sent to discord without re-encoding
     'noplaylist': True,
     'nocheckcertificate': True,
     'ignoreerrors': False,
@@ -27,11 +28,32 @@ YOUTUBE_DL_OPTIONS = {
     'no_warnings': True,
 }
 
-# Suppress noise about console usage from errors
-youtube_dl.utils.bug_reports_message = lambda: ''
+
+def setup_youtube_dl(module):
+    # Suppress noise about console usage from errors
+    module.utils.bug_reports_message = lambda: ''
+
+
+youtube_dl = lazy_import('youtube_dl', setup=setup_youtube_dl)
+
+
+def load_opus():
+    """Loads libopus the first time the bot joins a voice channel"""
+    if not discord.opus.is_loaded():
+        discord.opus.load_opus('libopus.so')
+
+
+log = logging.getLogger(__name__)
 
 api_keys = {"youtube": os.environ.get("YOUTUBE_API_KEY", os.environ.get('YOUTUBE_API'))}
 
+YOUTUBE_API_URL = "https://www.googleapis.com/youtube/v3/"
+YOUTUBE_API_CONCURRENCY = int(os.environ.get("YOUTUBE_API_CONCURRENCY", 4))
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "backendError"}
+MUSIC_PREFETCH = int(os.environ.get("MUSIC_PREFETCH", 2))  # upcoming songs resolved in the background
+MUSIC_IDLE_TIMEOUT = int(os.environ.get("MUSIC_IDLE_TIMEOUT", 300))  # seconds silent or alone before leaving
+MUSIC_IDLE_SWEEP = int(os.environ.get("MUSIC_IDLE_SWEEP", 60))
+
 
 class QueueEmpty(Exception):
     """Exception used when the queue is empty"""
@@ -43,10 +65,38 @@ class MusicNotPlaying(Exception):
     pass
 
 
-class YouTube:
+class DownloadCancelled(Exception):
+    """Exception used when a song's background resolution was cancelled while waiting for it"""
+    pass
+
+
+class YouTubeClient(WebClient):
     def __init__(self, *, loop):
+        """Pooled session for the YouTube Data API"""
+        super().__init__(loop=loop, limit_per_host=YOUTUBE_API_CONCURRENCY, timeout=10, retries=3)
+
+    def should_retry(self, response):
+        """Retries server errors and short-term rate limiting, but not exhausted quota"""
+        if super().should_retry(response):
+            return True
+        if response.status == 403:
+            try:
+                errors = response.json()["error"]["errors"]
+            except (ValueError, KeyError, IndexError, TypeError):
+                return False
+            return any(e.get("reason") in RATE_LIMIT_REASONS for e in errors)
+        return False
+
+
+class YouTube:
+    def __init__(self, *, loop, extractor):
         """Handles all YouTube video and playlists information"""
         self.loop = loop
+        self.extractor = extractor
+        self.client = YouTubeClient(loop=loop)
+        self.semaphore = asyncio.Semaphore(YOUTUBE_API_CONCURRENCY)
+        self.search_cache = SearchCache(loop=loop)
+        self.searches = SingleFlight("youtube search", loop=loop)
 
     @staticmethod
     def is_video_url(url):
@@ -63,68 +113,123 @@ class YouTube:
 
         return False
 
+    @staticmethod
+    def is_playlist_url(url):
+        """Checks whether a string is a YouTube playlist url, returns the playlist ID if it is"""
+        url_pattern = re.search(
+            r"http[s]?:\/\/(?:www\.)?youtube\.com\/playlist\?list=([\w-]+)", url)
+        if url_pattern is not None:
+            return url_pattern.group(1)
+
+        return False
+
+    @staticmethod
+    def parse_duration(duration):
+        """Converts an ISO 8601 duration such as PT1H2M3S into seconds"""
+        match = re.fullmatch(r"P(?:(\d+)D)?T?(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?", duration or "")
+        if match is None:
+            return None
+        days, hours, minutes, seconds = (int(g or 0) for g in match.groups())
+        return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
     async def api_call(self, endpoint, params):
         """Sends a request to the YouTube v3 API"""
-        params.update({"key": api_keys.get("youtube")})  # add api key to the payload
-        async with aiohttp.ClientSession() as session:
-            endpoint = "https://www.googleapis.com/youtube/v3/" + endpoint
-            response = await session.get(endpoint, params=params)
-            youtube_json = await response.json()  # Convert response to json
-            # If the request returned an error raise an exception
-            if youtube_json.get("error"):
-                message = youtube_json["error"]["errors"][0]["reason"]
-                raise aiohttp.http_exceptions.HttpBadRequest(message)
+        params = dict(params, key=api_keys.get("youtube"))  # add api key to the payload
+        async with self.semaphore:
+            response = await self.client.get(YOUTUBE_API_URL + endpoint, params=params)
+        youtube_json = response.json()  # Convert response to json
+        # If the request returned an error raise an exception
+        if youtube_json.get("error"):
+            message = youtube_json["error"]["errors"][0]["reason"]
+            raise aiohttp.http_exceptions.HttpBadRequest(message)
         return youtube_json
 
-    async def search(self, query):
-        """Searches YouTube for videos, returns list"""
-        payload = {"maxResults": "1",
+    async def close(self):
+        await self.client.close()
+        self.search_cache.close()
+
+    async def search_results(self, query, limit):
+        """Searches YouTube, returns a list of (video id, title), identical concurrent searches share one lookup"""
+        return await self.searches.do((normalize_query(query), limit), lambda: self._search_results(query, limit))
+
+    async def _search_results(self, query, limit):
+        """Consults the search cache before calling the API"""
+        results = await self.search_cache.run(self.search_cache.get, query, limit)
+        if results is not None:
+            return results
+
+        payload = {"maxResults": str(limit),
                    "part": "snippet",
                    "type": "video",
                    "q": query}
 
         youtube_json = await self.api_call("search", params=payload)
 
-        if youtube_json.get("items"):
-            video = youtube_json["items"][0]
-            video_id = video["id"]["videoId"]
-            video_title = video["snippet"]["title"]
-            return YouTubeVideo(video_id, title=video_title, loop=self.loop)
+        results = [(video["id"]["videoId"], video["snippet"]["title"])
+                   for video in youtube_json.get("items", [])]
+        await self.search_cache.run(self.search_cache.put, query, limit, results)
+        return results
+
+    async def search(self, query):
+        """Searches YouTube for videos, returns list"""
+        results = await self.search_results(query, 1)
+        if results:
+            video_id, video_title = results[0]
+            return YouTubeVideo(video_id, title=video_title, loop=self.loop, extractor=self.extractor)
         else:
             return None
 
+    async def playlist(self, playlist_id):
+        """Pages through a playlist 50 videos at a time, yields a list of videos per page"""
+        payload = {"maxResults": "50",
+                   "part": "contentDetails",
+                   "playlistId": playlist_id}
+
+        while True:
+            page = await self.api_call("playlistItems", params=payload)
+            video_ids = [item["contentDetails"]["videoId"] for item in page.get("items", [])]
+            videos = []
+            if video_ids:
+                # one videos.list call fills in titles and durations for the whole page
+                details = await self.api_call("videos", params={"part": "snippet,contentDetails",
+                                                                "id": ",".join(video_ids),
+                                                                "maxResults": "50"})
+                for video in details.get("items", []):  # private and deleted videos are left out
+                    videos.append(YouTubeVideo(
+                        video["id"], title=video["snippet"]["title"], loop=self.loop, extractor=self.extractor,
+                        duration=self.parse_duration(video["contentDetails"].get("duration"))))
+            yield videos
+
+            if not page.get("nextPageToken"):
+                break
+            payload["pageToken"] = page["nextPageToken"]
+
     async def search_many(self, query, limit=5):
         """Searches YouTube for videos, returns list"""
-        payload = {"maxResults": str(limit),
-                   "part": "snippet",
-                   "type": "video",
-                   "q": query}
-
-        youtube_json = await self.api_call("search", params=payload)
-
-        videos_json = youtube_json.get("items")
-        video_ids = (video["id"]["videoId"]
-                     for video in videos_json)  # All video IDs
-        video_titles = (video["snippet"]["title"]
-                        for video in videos_json)  # All video title
+        results = await self.search_results(query, limit)
         videos = []
-        for video_title, video_id in zip(video_titles, video_ids):
+        for video_id, video_title in results:
             videos.append(YouTubeVideo(
-                video_id, title=video_title, loop=self.loop))
+                video_id, title=video_title, loop=self.loop, extractor=self.extractor))
 
         return videos
 
 
 class YouTubeVideo:
-    def __init__(self, video_url, title=None, *, loop=None):
+    __slots__ = ("video_url", "title", "loop", "extractor", "channel", "requester", "track", "resolving",
+                 "known_duration")
+
+    def __init__(self, video_url, title=None, *, loop=None, extractor, duration=None):
         """Represents a YouTube video"""
         self.video_url = video_url
         self.loop = loop or asyncio.get_event_loop()
-        self.ytdl = youtube_dl.YoutubeDL(YOUTUBE_DL_OPTIONS)
+        self.extractor = extractor
         self.title = title
+        self.known_duration = duration
         self.channel = None
         self.requester = None
-        self.downloaded = False
+        self.track = None
+        self.resolving = None
 
     def __str__(self):
         return self.title or self.video_url
@@ -132,14 +237,60 @@ class YouTubeVideo:
     def __repr__(self):
         return "<YoutubeVideo: {}>".format(self.__str__())
 
-    async def download(self):
-        if not self.downloaded:
-            self.data = await self.loop.run_in_executor(None, self.ytdl.extract_info, self.video_url, False)
-            for name, value in self.data.items():
-                if type(value) not in (list, tuple, dict):
-                    # convert dictionary into variables
-                    setattr(self, name, value)
-            self.downloaded = True
+    @property
+    def downloaded(self):
+        return self.track is not None
+
+    @property
+    def duration(self):
+        return self.track.duration if self.track else self.known_duration
+
+    @property
+    def thumbnail(self):
+        return self.track.thumbnail if self.track else None
+
+    @property
+    def webpage_url(self):
+        return self.track.webpage_url if self.track else None
+
+    async def download(self, key=None):
+        if self.needs_download():
+            with metrics.timer("song_download_seconds"):
+                task = self.start_download(key)
+                # unlike shield, wait only raises CancelledError when the caller itself is cancelled
+                await asyncio.wait({task})
+                if task.cancelled():
+                    raise DownloadCancelled("The download of {} was cancelled".format(self))
+                task.result()
+
+    def needs_download(self):
+        """Checks whether the video has to be resolved, or re-resolved because its stream url expires soon"""
+        return self.track is None or not self.extractor.is_playable(self.track)
+
+    def start_download(self, key=None):
+        """Starts resolving the video in the background, concurrent callers share one task"""
+        if self.resolving is None or self.resolving.done():
+            if key is None and self.channel is not None:
+                key = self.channel.guild.id
+            self.resolving = self.loop.create_task(self.resolve(key))
+            self.resolving.add_done_callback(self.resolved)
+        return self.resolving
+
+    def resolved(self, task):
+        """Forgets a finished resolution, even one cancelled before it started running"""
+        if self.resolving is task:
+            self.resolving = None
+        if not task.cancelled():
+            task.exception()  # retrieved here so an unawaited failure isn't logged
+
+    def cancel_download(self):
+        """Cancels a background resolution that is no longer needed"""
+        if self.resolving is not None:
+            self.resolving.cancel()
+
+    async def resolve(self, key):
+        self.track = await self.extractor.resolve(self.video_url, key=key)
+        self.title = self.track.title
 
     def embed(self, music_queue=None):
         if self.downloaded:
@@ -167,97 +318,17 @@ class YouTubeVideo:
     @property
     def source(self):
         if self.downloaded:
-            return discord.FFmpegPCMAudio(self.data.get("url"))
+            return create_source(self.track, self.extractor.audio_cache)
         else:
             return None
 
     @classmethod
-    async def from_url(cls, video_url, *, loop=None):
-        video = cls(video_url, loop=loop)
-        await video.download()
+    async def from_url(cls, video_url, *, loop=None, extractor, key=None):
+        video = cls(video_url, loop=loop, extractor=extractor)
+        await video.download(key)
         return video
 
 
-class MusicQueue:
-    def __init__(self):
-        """Represents a music queue"""
-        self.normal = []
-        self.shuffled = []
-        self.looping = []
-
-    def loop(self, *, nowplaying):
-        """Enables or disables looping"""
-        if not self.looping:
-            self.looping = list(self.visible)
-            self.looping.insert(0, nowplaying)
-            if not self.visible:
-                self.visible = list(self.looping)
-        else:
-            self.looping = []
-
-        return bool(self.looping)
-
-    def shuffle(self):
-        """Enables or disables shuffling"""
-        if not self.shuffled:
-            self.shuffled = list(self.visible)
-            random.shuffle(self.shuffled)
-        else:
-            self.shuffled = []
-
-        return bool(self.shuffled)
-
-    def clear(self):
-        """Clears all playlists"""
-        self.normal = []
-        self.shuffled = []
-        self.looping = []
-
-    def get_next_song(self):
-        """Gets the next song in the queue, accounts for shuffled queues"""
-        try:
-            song = None
-            song = self.normal[0]
-            song = self.shuffled[0]
-        except IndexError:
-            pass
-
-        return song
-
-    def remove(self, obj):
-        """Removes a song from the list, accounts for shuffled and looping queues"""
-        self.normal.remove(obj)
-        if self.shuffled:
-            self.shuffled.remove(obj)
-
-        if not self.normal:
-            self.normal = list(self.looping)
-            self.shuffled = list(self.looping)
-
-    def add(self, obj):
-        """Adds a song to the queue, accounts for shuffled and looping queues"""
-        self.normal.append(obj)
-        if self.shuffled:
-            self.shuffled.append(obj)
-        if self.looping:
-            self.looping.append(obj)
-
-    @property
-    def visible(self):
-        """Returns the queue which the user will see"""
-        if self.shuffled:
-            return self.shuffled
-        else:
-            return self.normal
-
-    @visible.setter
-    def visible(self, new):
-        """Changes the queue, and changes the shuffled queue if necessary"""
-        if self.shuffled:
-            self.shuffled = new
-        self.normal = new
-
-
 class VoiceState:
 
     def __init__(self, bot):
@@ -270,12 +341,48 @@ class VoiceState:
         self.music_player = self.bot.loop.create_task(self.music_player_task())
         self.allow_batch_jobs = True
         self.batch_job = False
+        self.prefetching = set()
+        self.last_active = time.monotonic()
+        self.alone_since = None
+
+    def touch(self):
+        """Marks the voice state as in use"""
+        self.last_active = time.monotonic()
 
     def pause(self):
-        print("Paused")
+        """Pauses playback while nobody is listening"""
+        self.alone_since = time.monotonic()
+        if self.is_playing():
+            self.voice.pause()
 
     def resume(self):
-        print("Resumed")
+        """Resumes playback once someone is listening again"""
+        self.alone_since = None
+        self.touch()
+        if self.voice is not None and self.voice.is_paused():
+            self.voice.resume()
+
+    def is_idle(self, timeout=MUSIC_IDLE_TIMEOUT):
+        """Checks whether the bot has been silent or alone in the channel for longer than timeout"""
+        if self.music_player.done():  # crashed or cancelled, nothing left to play
+            return True
+        now = time.monotonic()
+        if self.alone_since is not None and now - self.alone_since > timeout:
+            return True
+        return not self.is_playing() and self.current is None and now - self.last_active > timeout
+
+    async def disconnect(self):
+        """Stops the player, cancels background resolution and leaves the voice channel"""
+        self.music_player.cancel()
+        self.allow_batch_jobs = False
+        for song in self.prefetching:
+            song.cancel_download()
+        self.prefetching = set()
+        self.queue.clear()
+        self.current = None
+        if self.voice is not None:
+            voice, self.voice = self.voice, None
+            await voice.disconnect()
 
     def is_playing(self):
         """Shows you if the bot is playing or not, returns boolean"""
@@ -293,53 +400,95 @@ class VoiceState:
 
         song.channel = context.channel
         song.requester = context.author
+        self.touch()
         self.queue.add(song)
         if self.current is None:
             self.play_next_song.set()
+        self.prefetch()
         return True
 
+    def prefetch(self):
+        """Resolves the next few songs in the background, cancelling ones that are no longer upcoming"""
+        upcoming = [song for song in self.queue.visible[:MUSIC_PREFETCH] if song.needs_download()]
+        for song in self.prefetching.difference(upcoming):
+            if song is not self.current:
+                song.cancel_download()
+        for song in upcoming:
+            song.start_download()
+        self.prefetching = set(upcoming)
+
     def toggle_next_song(self, error):
         """Toggles the next song by setting the play_next_song event"""
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
     async def music_player_task(self):
         """Manages the voice interaction with the guild"""
-        await self.play_next_song.wait()
-
-        while self.queue.get_next_song() is not None:
-            self.play_next_song.clear()
-            self.current = self.queue.get_next_song()
-            await self.current.download()
-            self.queue.remove(self.current)
-            self.voice.play(self.current.source, after=self.toggle_next_song)
-
+        while True:
             await self.play_next_song.wait()
 
-        await self.current.channel.send("Queue concluded.")
+            song = None
+            while self.queue.get_next_song() is not None:
+                self.play_next_song.clear()
+                song = self.current = self.queue.get_next_song()
+                try:
+                    await song.download()
+                    if self.queue.get_next_song() is not song:
+                        continue  # stopped or removed while it was resolving
+                    self.queue.remove(song)
+                    self.voice.play(song.source, after=self.toggle_next_song)
+                except asyncio.CancelledError:
+                    raise  # the player itself is being cancelled
+                except DownloadCancelled:
+                    continue  # a prefetch cancelled under us, the song is resolved again if it's still next
+                except Exception as e:
+                    await self.skip_failed_song(song, e)
+                    continue
+                self.touch()
+                self.prefetch()
+
+                await self.play_next_song.wait()
+
+            if song is not None:
+                await song.channel.send("Queue concluded.")
+
+            self.current = None
+            self.touch()
+            self.play_next_song.clear()
 
+    async def skip_failed_song(self, song, error):
+        """Drops a song that couldn't be resolved or played and tells its channel"""
+        log.warning("Could not play %r: %s", song, error)
         self.current = None
-        self.play_next_song.clear()
-        self.music_player = self.bot.loop.create_task(self.music_player_task())
+        self.queue.drop(song)  # from the loop too, or it would be retried forever
+        try:
+            await song.channel.send("Couldn't play {}: {}".format(song, error))
+        except discord.HTTPException:
+            pass
 
     async def join_voice_channel(self, voice_channel):
         """Joins a voice channel, returns discord.VoiceClient object"""
         if self.voice is not None:
             return await self.voice.move_to(voice_channel)
 
+        load_opus()
         self.voice = await voice_channel.connect()
         return self.voice
 
     def shuffle(self):
         """Shuffles or unshuffles the queue"""
         if self.queue.visible:
-            return self.queue.shuffle()
+            shuffled = self.queue.shuffle()
+            self.prefetch()
+            return shuffled
         else:
             raise QueueEmpty("Can't shuffle when the queue is empty")
 
     def loop(self):
         """Enables or disbales looping of the queue"""
         if self.queue.visible or self.current:
-            return self.queue.loop(nowplaying=self.current)
+            looping = self.queue.loop(nowplaying=self.current)
+            self.prefetch()
+            return looping
         else:
             raise QueueEmpty("Can't loop when the queue is empty")
 
@@ -350,28 +499,74 @@ class VoiceState:
             return True
 
     def stop(self):
+        """Stops the bot by skipping the song and clearing the queue"""
+        stopped = False
+        if self.batch_job:
+            self.allow_batch_jobs = False  # stop any ongoing batch jobs
+            stopped = True
+        if stopped or self.queue.visible or self.current is not None:  # even between songs, or while one is resolving
+            self.queue.clear()  # including the pages a batch job already queued
+            self.prefetch()
+            stopped = True
         if self.is_playing():
-            """Stops the bot by skipping the song and clearing the queue"""
-            if self.batch_job:
-                self.allow_batch_jobs = False  # stop any ongoing batch jobs
-            self.queue.clear()
             self.voice.stop()
-            return True
+            stopped = True
+        elif self.current is not None:
+            self.current.cancel_download()  # stopped before it started playing
+        return stopped
 
 
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.voice_states = {}
-        self.youtube = YouTube(loop=self.bot.loop)
-
-    def on_voice_state_update(self, member, before, after):
+        self.audio_cache = AudioCache() if AUDIO_CACHE_BYTES and AUDIO_PASSTHROUGH else None  # it stores Opus
+        self.extractor = ExtractorPool(YOUTUBE_DL_OPTIONS, loop=self.bot.loop, audio_cache=self.audio_cache)
+        self.youtube = YouTube(loop=self.bot.loop, extractor=self.extractor)
+        self.idle_task = self.bot.loop.create_task(self.evict_idle_states())
+
+    def cog_unload(self):
+        self.idle_task.cancel()
+        for state in self.voice_states.values():
+            self.bot.loop.create_task(state.disconnect())
+        self.voice_states.clear()
+        self.bot.loop.create_task(self.youtube.close())
+        self.extractor.close()
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
         state = self.voice_states.get(member.guild)
-        if state and state.voice and state.voice.channel:
-            if len(after.members) == 1:
-                state.pause()
-            elif len(before.members) == 1 and len(after.members) > 1:
-                state.resume()
+        if state is None:
+            return
+        if member == self.bot.user and after.channel is None:  # kicked or disconnected
+            return await self.remove_voice_state(member.guild)
+        if state.voice is None or state.voice.channel is None:
+            return
+
+        channel = state.voice.channel
+        if before.channel != channel and after.channel != channel:
+            return
+        if all(m.bot for m in channel.members):
+            state.pause()
+        elif state.alone_since is not None:
+            state.resume()
+
+    async def remove_voice_state(self, guild):
+        """Disconnects and forgets the voice state of a guild"""
+        state = self.voice_states.pop(guild, None)
+        if state is not None:
+            await state.disconnect()
+
+    async def evict_idle_states(self):
+        """Periodically disconnects from channels that have been silent or empty for too long"""
+        while True:
+            await asyncio.sleep(MUSIC_IDLE_SWEEP)
+            for guild, state in list(self.voice_states.items()):
+                if state.is_idle():
+                    try:
+                        await self.remove_voice_state(guild)
+                    except Exception:
+                        log.exception("Failed to disconnect idle voice state of %s", guild)
 
     def get_voice_state(self, guild):
         """Gets the VoiceState object associated with the guild"""
@@ -385,6 +580,7 @@ class Music(commands.Cog):
     @commands.is_owner()
     async def musicstates(self, ctx):
         response = []
+        idle = 0
         for server, state in self.voice_states.items():
             if state.is_playing():
                 server_string = "{} - {}".format(server.name, len(state.queue.visible))
@@ -393,11 +589,34 @@ class Music(commands.Cog):
                 if state.queue.shuffled:
                     server_string += " S"
                 response.append(server_string)
+            else:
+                idle += 1
 
-        if not response:
-            await ctx.send("No servers are using voice currently")
-        else:
-            await ctx.send("```" + "\n".join(response) + "```")
+        response.append("{} live, {} idle, {} tasks".format(len(response), idle, len(asyncio.all_tasks())))
+        await ctx.send("```" + "\n".join(response) + "```")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def searchcache(self, ctx, action=None):
+        """Shows the YouTube search cache and request coalescing statistics or flushes the cache"""
+        cache = self.youtube.search_cache
+        if action == "flush":
+            await cache.run(cache.clear)
+            return await ctx.send("The search cache has been flushed")
+        stats = dict(cache.stats(), **self.youtube.searches.stats())
+        await ctx.send("```" + "\n".join("{}: {}".format(k, v) for k, v in stats.items()) + "```")
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def audiocache(self, ctx, action=None):
+        """Shows the on-disk audio cache statistics or flushes the cache"""
+        cache = self.audio_cache
+        if cache is None:
+            return await ctx.send("The audio cache is disabled")
+        if action == "flush":
+            await self.bot.loop.run_in_executor(None, cache.clear)
+            return await ctx.send("The audio cache has been flushed")
+        await ctx.send("```" + "\n".join("{}: {}".format(k, v) for k, v in cache.stats().items()) + "```")
 
     @commands.command(hidden=True)
     @commands.guild_only()
@@ -414,9 +633,14 @@ class Music(commands.Cog):
         if ctx.author.voice is None:
             return await ctx.send("You aren't in a voice channel")
 
+        playlist_id = self.youtube.is_playlist_url(query)
+        if playlist_id:
+            return await self.play_playlist(ctx, playlist_id)
+
         youtube_url = self.youtube.is_video_url(query)
         if youtube_url:
-            song = await YouTubeVideo.from_url(youtube_url, loop=self.bot.loop)
+            song = await YouTubeVideo.from_url(youtube_url, loop=self.bot.loop,
+                                               extractor=self.extractor, key=ctx.guild.id)
         else:
             song = await self.youtube.search(query)
 
@@ -426,6 +650,31 @@ class Music(commands.Cog):
 
         await ctx.send(embed=song.embed(music_queue=state.queue))
 
+    async def play_playlist(self, ctx, playlist_id):
+        """Streams a playlist into the queue page by page, playback starts after the first page"""
+        state = self.get_voice_state(ctx.guild)
+        await state.join_voice_channel(ctx.author.voice.channel)
+        message = await ctx.send("Importing playlist...")
+
+        added = 0
+        total_duration = 0
+        try:
+            async for page in self.youtube.playlist(playlist_id):
+                for song in page:
+                    if not state.add_song_to_playlist(song, batch_job=True, context=ctx):
+                        return await message.edit(content="Playlist import stopped after {} songs".format(added))
+                    added += 1
+                    total_duration += song.duration or 0
+                await message.edit(content="Importing playlist... {} songs so far".format(added))
+        finally:
+            state.batch_job = False
+            state.allow_batch_jobs = True
+
+        minutes, seconds = divmod(total_duration, 60)
+        hours, minutes = divmod(minutes, 60)
+        await message.edit(content="Added {} songs from the playlist ({}:{:02}:{:02})".format(
+                           added, hours, minutes, seconds))
+
     @commands.command(aliases=["np"])
     @commands.guild_only()
     async def nowplaying(self, ctx):
@@ -0,0 +1,104 @@
+import threading
+import sqlite3
+import asyncio
+import json
+import time
+import os
+import re
+
+
+SEARCH_CACHE_DB = os.environ.get('SEARCH_CACHE_DB', 'search_cache.db')
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 7 * 86400))
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 5000))
+SEARCH_QUOTA_COST = 100  # YouTube Data API units per search.list call
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_cache (
+    query TEXT NOT NULL,
+    max_results INTEGER NOT NULL,
+    results TEXT NOT NULL,
+    stored REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (query, max_results)
+);
+CREATE INDEX IF NOT EXISTS search_cache_last_used ON search_cache (last_used);
+"""
+
+
+def normalize_query(query):
+    """Normalizes case, punctuation and whitespace so equivalent searches share an entry"""
+    query = re.sub(r'[^\w\s]', ' ', query.casefold())
+    return ' '.join(query.split())
+
+
+class SearchCache:
+    def __init__(self, path=SEARCH_CACHE_DB, *, loop=None, ttl=SEARCH_CACHE_TTL, max_size=SEARCH_CACHE_SIZE):
+        """Persistent query to video cache with expiry and LRU eviction"""
+        self.path = path
+        self.loop = loop
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.size = self.db.execute('SELECT COUNT(*) FROM search_cache').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def run(self, func, *args):
+        """Runs a blocking database function in the executor"""
+        loop = self.loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, func, *args)
+
+    def get(self, query, max_results):
+        """Returns the cached list of (video id, title), or None on a miss"""
+        key = normalize_query(query)
+        now = time.time()
+        with self.lock, self.db:
+            row = self.db.execute('SELECT results, stored FROM search_cache WHERE query = ? AND max_results = ?',
+                                  (key, max_results)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            self.db.execute('UPDATE search_cache SET last_used = ? WHERE query = ? AND max_results = ?',
+                            (now, key, max_results))
+        self.hits += 1
+        return [tuple(r) for r in json.loads(row[0])]
+
+    def put(self, query, max_results, results):
+        key = normalize_query(query)
+        now = time.time()
+        with self.lock, self.db:
+            exists = self.db.execute('SELECT 1 FROM search_cache WHERE query = ? AND max_results = ?',
+                                     (key, max_results)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?, ?, ?)',
+                            (key, max_results, json.dumps(results), now, now))
+            if exists is None:
+                self.size += 1
+            if self.size > self.max_size:
+                overflow = self.size - self.max_size
+                self.db.execute('DELETE FROM search_cache WHERE rowid IN '
+                                '(SELECT rowid FROM search_cache ORDER BY last_used LIMIT ?)', (overflow,))
+                self.size -= overflow
+                self.evictions += overflow
+
+    def clear(self):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM search_cache')
+            self.size = 0
+
+    def stats(self):
+        """Returns a dictionary of cache statistics"""
+        lookups = self.hits + self.misses
+        return {'entries': self.size,
+                'max size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit rate': '{:.1%}'.format(self.hits / lookups) if lookups else 'n/a',
+                'quota saved': self.hits * SEARCH_QUOTA_COST,
+                'evictions': self.evictions}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,61 @@
+import asyncio
+import metrics
+
+
+class SingleFlight:
+    def __init__(self, name, *, loop=None):
+        """Coalesces concurrent calls for the same key into one in-flight call
+
+        The first caller for a key starts the call, everyone arriving while it
+        runs awaits the same task and gets the same result or exception. The
+        call is only cancelled once every caller waiting on it has gone."""
+        self.name = name
+        self.loop = loop
+        self.calls = {}
+        self.waiters = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        """Returns the result of the coroutine function func, shared with concurrent callers of key"""
+        task = self.calls.get(key)
+        if task is None:
+            loop = self.loop or asyncio.get_event_loop()
+            task = self.calls[key] = loop.create_task(func())
+            task.add_done_callback(lambda task: self._done(key, task))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+            metrics.increment('singleflight_coalesced_total', flight=self.name)
+
+        self.waiters[key] = self.waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self.waiters[key] == 1 and not task.done():
+                if self.calls.get(key) is task:
+                    del self.calls[key]  # so a new caller doesn't join the dying task
+                task.cancel()  # nobody else is waiting for it
+            raise
+        finally:
+            self.waiters[key] -= 1
+            if not self.waiters[key]:
+                del self.waiters[key]
+
+    def __contains__(self, key):
+        """Checks whether a call for key is in flight"""
+        return key in self.calls
+
+    def _done(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            task.exception()  # retrieved here so an unawaited failure isn't logged
+
+    def stats(self):
+        """Returns a dictionary of coalescing statistics"""
+        total = self.executed + self.coalesced
+        return {'in flight': len(self.calls),
+                'upstream calls': self.executed,
+                'calls saved': self.coalesced,
+                'saved rate': '{:.1%}'.format(self.coalesced / total) if total else 'n/a'}
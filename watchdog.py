@@ -0,0 +1,105 @@
+from collections import deque
+import traceback
+import threading
+import asyncio
+import logging
+import metrics
+import time
+import sys
+import os
+
+
+log = logging.getLogger(__name__)
+
+WATCHDOG_INTERVAL = float(os.environ.get('WATCHDOG_INTERVAL', 0.1))
+WATCHDOG_THRESHOLD = float(os.environ.get('WATCHDOG_THRESHOLD', 0.25))  # seconds of lag reported as blocking
+WATCHDOG_WINDOW = int(os.environ.get('WATCHDOG_WINDOW', 3000))  # samples kept for the rolling percentiles
+
+
+class LoopWatchdog:
+    def __init__(self, loop, *, interval=WATCHDOG_INTERVAL, threshold=WATCHDOG_THRESHOLD, window=WATCHDOG_WINDOW):
+        """Measures event loop lag and logs what the loop was doing whenever it blocks
+
+        A ticker coroutine samples how late its sleeps wake up. A separate
+        thread watches the ticker's heartbeat, and once the loop has missed it
+        by more than threshold, captures the loop thread's stack while the
+        blocking call is still on it."""
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=window)
+        self.commands = {}  # task -> command context, for blame
+        self.stalls = 0
+        self.worst = 0.0
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.task = self.loop.create_task(self.ticker())
+        self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def ticker(self):
+        self.loop_thread = threading.get_ident()
+        while True:
+            self.heartbeat = time.monotonic()
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(self.loop.time() - start - self.interval, 0.0)
+            self.samples.append(lag)
+            self.worst = max(self.worst, lag)
+            metrics.observe('loop_lag_seconds', lag)  # stalls are logged by watch(), with a stack
+
+    def watch(self):
+        """Runs on the watchdog thread, reports each stall once while it is happening"""
+        reported = None
+        while not self.stopping.wait(self.interval / 2):
+            heartbeat = self.heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled > self.threshold and reported != heartbeat and self.loop_thread is not None:
+                reported = heartbeat
+                self.stalls += 1
+                self.report(stalled)
+
+    def report(self, stalled):
+        frame = sys._current_frames().get(self.loop_thread)
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else 'unavailable\n'
+        ctx = self.commands.get(asyncio.current_task(self.loop))
+        if ctx is not None:
+            guild = ctx.guild.name if ctx.guild is not None else 'direct message'
+            blame = 'command {} in {}'.format(ctx.command.qualified_name, guild)
+        else:
+            blame = 'no command'
+        log.warning('Event loop blocked for over %.0fms running %s, loop thread stack:\n%s',
+                    stalled * 1000, blame, stack)
+
+    async def command_started(self, ctx):
+        """Before invoke hook, runs in the command's own task"""
+        self.commands[asyncio.current_task(self.loop)] = ctx
+
+    async def command_finished(self, ctx):
+        self.commands.pop(asyncio.current_task(self.loop), None)
+
+    def percentiles(self):
+        """Returns the rolling lag percentiles in seconds"""
+        samples = sorted(self.samples)
+        if not samples:
+            return {}
+        pick = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)]
+        return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1]}
+
+    def stats(self):
+        """Returns a dictionary of lag statistics for display"""
+        stats = {name: '{:.1f}ms'.format(value * 1000) for name, value in self.percentiles().items()}
+        stats['samples'] = len(self.samples)
+        stats['worst ever'] = '{:.1f}ms'.format(self.worst * 1000)
+        stats['stalls reported'] = self.stalls
+        return stats
@@ -0,0 +1,107 @@
+from urllib.parse import urlsplit
+import metrics
+import aiohttp
+import asyncio
+import random
+import json
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class WebResponse:
+    def __init__(self, status, url, headers, body, request_info=None):
+        """Represents a fully read HTTP response"""
+        self.status = status
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.request_info = request_info or aiohttp.RequestInfo(url, 'GET', headers)
+
+    @property
+    def text(self):
+        """Returns the body decoded as text"""
+        return self.body.decode('utf-8', errors='replace')
+
+    def json(self):
+        """Returns the body decoded as json"""
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        """Raises an exception if the response was an HTTP error"""
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(self.request_info, (), status=self.status,
+                                              message='HTTP {}'.format(self.status), headers=self.headers)
+
+
+class WebClient:
+    def __init__(self, *, loop=None, limit=20, limit_per_host=4, timeout=15,
+                 keepalive=30, retries=3, backoff=0.5, headers=None, cookie_jar=None):
+        """Owns a long-lived, connection pooled aiohttp session with retries"""
+        self.loop = loop
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff = backoff
+        self.headers = headers
+        self.cookie_jar = cookie_jar
+        self._session = None
+
+    @property
+    def closed(self):
+        return self._session is None or self._session.closed
+
+    def get_session(self):
+        """Gets the shared session, creating it on first use"""
+        if self.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive, loop=self.loop)
+            self._session = aiohttp.ClientSession(connector=connector, loop=self.loop,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                  headers=self.headers, cookie_jar=self.cookie_jar)
+        return self._session
+
+    def should_retry(self, response):
+        """Checks whether a response is a transient error worth retrying"""
+        return response.status in RETRY_STATUSES
+
+    def retry_delay(self, attempt):
+        """Exponential backoff with full jitter"""
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    async def request(self, method, url, *, retries=None, **kwargs):
+        """Sends a request, retrying connection errors and transient statuses"""
+        retries = self.retries if retries is None else retries
+        host = urlsplit(str(url)).netloc
+        attempt = 0
+        while True:
+            try:
+                with metrics.timer('http_request_seconds', host=host, method=method):
+                    async with self.get_session().request(method, url, **kwargs) as response:
+                        body = await response.read()
+                        result = WebResponse(response.status, response.url, response.headers, body,
+                                             response.request_info)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt >= retries:
+                    raise
+            else:
+                metrics.increment('http_responses_total', host=host, status=result.status)
+                if not self.should_retry(result) or attempt >= retries:
+                    return result
+            metrics.increment('http_retries_total', host=host)
+            await asyncio.sleep(self.retry_delay(attempt))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+    async def close(self):
+        """Closes the shared session and its connection pool"""
+        if not self.closed:
+            await self._session.close()
+        self._session = None